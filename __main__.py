@@ -0,0 +1,9 @@
+if __name__ == '__main__':
+    # the package modules use relative imports, so import them through
+    # the directory name, which may not be a valid identifier
+    import importlib
+    import os
+    import sys
+    directory = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.dirname(directory))
+    importlib.import_module(os.path.basename(directory) + '.batch').main()
@@ -0,0 +1,99 @@
+""" Analyses directories of solution files without Sublime Text, printing
+    one JSON object per skeleton. Run the package directory with python,
+    e.g. `python sublime_fewest_moves attempts/ -o results.jsonl`. """
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+from .document import Document
+from .facelet_cube import FaceletCube
+from .cycle_analyzer import analyze_cube, total_cycles
+
+EXTENSIONS = ('.fm', '.fmc')
+
+def find_files(paths):
+    """ Yields the solution files among paths, directories are searched
+        recursively in sorted order. """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(EXTENSIONS):
+                    yield os.path.join(root, name)
+
+def analyze_text(text):
+    """ Returns a record for every skeleton of a solution file. """
+    document = Document()
+    document.update(text)
+    scramble = document.scramble
+    scrambleCube = FaceletCube(scramble)
+    records = []
+    for block in document.blocks():
+        skeleton = block.skeleton
+        result = analyze_cube(scrambleCube.copy().apply(skeleton))
+        cycles = total_cycles(result)
+        records.append({
+            'line': block.first + 1,
+            'scramble': scramble,
+            'skeleton': skeleton,
+            'moves': block.total,
+            'length': len(skeleton.split()),
+            'solved': cycles == 0,
+            'cycles': cycles,
+            'corner_cycles': result['corner_cycles'],
+            'edge_cycles': result['edge_cycles'],
+            'center_cycles': result['center_cycles'],
+            'parity': result['parity'],
+        })
+    return records
+
+def analyze_file(path):
+    """ Returns the records of a file, or a single record holding the
+        error when it can't be read. """
+    try:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            text = f.read()
+    except OSError as e:
+        return [{'file': path, 'error': e.strerror}]
+    records = analyze_text(text)
+    for record in records:
+        record['file'] = path
+    return records
+
+def run(paths, output, processes=0):
+    """ Writes the records of all files to output as JSON Lines, files are
+        spread over a process pool. Returns the number of records. """
+    files = list(find_files(paths))
+    processes = processes or multiprocessing.cpu_count() or 1
+    count = 0
+    if processes > 1 and len(files) > 1:
+        with multiprocessing.Pool(min(processes, len(files))) as pool:
+            results = pool.imap(analyze_file, files, chunksize=8)
+            for records in results:
+                count += write_records(records, output)
+    else:
+        for path in files:
+            count += write_records(analyze_file(path), output)
+    return count
+
+def write_records(records, output):
+    for record in records:
+        output.write(json.dumps(record, sort_keys=True) + '\n')
+    return len(records)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Print move counts and cycles of every skeleton in .fm/.fmc files as JSON Lines.')
+    parser.add_argument('paths', nargs='+', help='files or directories to analyse')
+    parser.add_argument('-j', '--processes', type=int, default=0, help='worker processes, 0 means one per CPU')
+    parser.add_argument('-o', '--output', help='output file, standard output by default')
+    args = parser.parse_args(argv)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            run(args.paths, output, args.processes)
+    else:
+        run(args.paths, sys.stdout, args.processes)
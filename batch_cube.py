@@ -0,0 +1,110 @@
+""" Many cubes simulated at once with NumPy, for bulk grading outside
+    Sublime Text. Sublime doesn't ship NumPy and loads this module along
+    with the plugin, so NumPy is only imported on first use. """
+
+from itertools import chain
+from .move_transformer import MOVE_NAMES, tokenize, parse_move
+from .facelet_cube import FaceletCube, SOLVED, MOVE_TABLES
+from .cycle_analyzer import CORNER_FACELETS, EDGE_FACELETS
+
+numpy = None
+
+# code of the identity move used to pad shorter sequences
+PADDING = 18
+# moves applied by one table lookup, 19 ** 3 tables of 54 bytes
+CHUNK = 3
+
+MOVE_CODES = {name: code for code, name in enumerate(MOVE_NAMES)}
+
+def require_numpy():
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError('BatchCube needs NumPy, install it with `pip install numpy`')
+
+def sequence_codes(sequences):
+    """ Returns the move codes of sequences as an (N, L) array, sequences
+        shorter than L are padded with PADDING. """
+    require_numpy()
+    parsed = []
+    for sequence in sequences:
+        try:
+            # normalized sequences only hold face turns split by spaces
+            parsed.append([MOVE_CODES[move] for move in sequence.split()])
+        except KeyError:
+            parsed.append([axis * 3 + amount - 1 for axis, amount in map(parse_move, tokenize(sequence))])
+    lengths = numpy.array([len(codes) for codes in parsed], dtype=numpy.intp)
+    length = int(lengths.max()) if len(parsed) else 0
+    codes = numpy.full((len(parsed), length), PADDING, dtype=numpy.uint8)
+    codes[numpy.arange(length) < lengths[:, None]] = numpy.fromiter(chain.from_iterable(parsed), dtype=numpy.uint8, count=int(lengths.sum()))
+    return codes
+
+class BatchCube:
+    """ N cubes as an (N, 54) uint8 array, row n holding the state of a
+        FaceletCube. """
+
+    tables = None
+
+    def __init__(self, count=0, states=None):
+        require_numpy()
+        if BatchCube.tables is None:
+            moves = numpy.array([list(table) for table in MOVE_TABLES] + [list(SOLVED)], dtype=numpy.uint8)
+            # tables[(a * 19 + b) * 19 + c] applies moves a, b and c
+            tables = moves
+            for i in range(CHUNK - 1):
+                tables = numpy.take_along_axis(numpy.repeat(tables, len(moves), axis=0), numpy.tile(moves, (len(tables), 1)), axis=1)
+            BatchCube.tables = tables
+            BatchCube.solved = numpy.frombuffer(SOLVED, dtype=numpy.uint8)
+            BatchCube.corners = numpy.array(CORNER_FACELETS, dtype=numpy.intp)
+            BatchCube.edges = numpy.array(EDGE_FACELETS, dtype=numpy.intp)
+        if states is None:
+            states = numpy.tile(BatchCube.solved, (count, 1))
+        self.states = states
+
+    @classmethod
+    def from_cubes(cls, cubes):
+        require_numpy()
+        states = numpy.frombuffer(b''.join(cube.state for cube in cubes), dtype=numpy.uint8)
+        return cls(states=states.reshape(-1, 54).copy())
+
+    def __len__(self):
+        return len(self.states)
+
+    def apply(self, sequences):
+        """ Applies one sequence to each cube. """
+        return self.apply_codes(sequence_codes(sequences))
+
+    def apply_codes(self, codes):
+        """ Applies an (N, L) array of move codes, PADDING leaving a cube
+            unchanged. """
+        codes = numpy.asarray(codes, dtype=numpy.intp)
+        padding = -codes.shape[1] % CHUNK
+        if padding:
+            codes = numpy.concatenate([codes, numpy.full((len(codes), padding), PADDING, dtype=numpy.intp)], axis=1)
+        states = self.states
+        for column in range(0, codes.shape[1], CHUNK):
+            index = codes[:, column]
+            for offset in range(1, CHUNK):
+                index = index * (PADDING + 1) + codes[:, column + offset]
+            states = numpy.take_along_axis(states, self.tables[index], axis=1)
+        self.states = states
+        return self
+
+    def copy(self):
+        return BatchCube(states=self.states.copy())
+
+    def is_solved(self):
+        """ Returns a boolean array, True for solved cubes. """
+        return (self.states == self.solved).all(axis=1)
+
+    def misplaced(self):
+        """ Returns the number of corners and edges of each cube that are
+            not solved, moved or only twisted or flipped. """
+        corners = (self.states[:, self.corners] != self.corners).any(axis=2).sum(axis=1)
+        edges = (self.states[:, self.edges] != self.edges).any(axis=2).sum(axis=1)
+        return corners + edges
+
+    def cube(self, index):
+        return FaceletCube(state=self.states[index].tobytes())
@@ -0,0 +1,46 @@
+""" Synthetic solution files, the same seed always gives the same text. """
+
+import os
+import random
+
+FACES = 'URFDLB'
+SUFFIXES = ['', '2', "'"]
+# notation that shows up in real attempts next to plain face turns
+EXTRAS = ['Rw', 'Uw2', "Fw'", '2Lw', 'x', "y'", 'z2', '[u]', "[r']", 'NISS']
+COMMENTS = ['', '', '', ' // 2x2x2', ' # eo', ' // pseudo 2x2x3', ' # insertion here']
+
+def random_moves(rng, count, extras=0.0):
+    moves = []
+    last = None
+    while len(moves) < count:
+        if rng.random() < extras:
+            moves.append(rng.choice(EXTRAS))
+            continue
+        face = rng.choice(FACES)
+        if face == last:
+            continue
+        last = face
+        moves.append(face + rng.choice(SUFFIXES))
+    return moves
+
+def generate(skeletons, seed=0):
+    """ Returns a file with a scramble and the given number of skeletons
+        of one to four lines each. """
+    rng = random.Random(seed)
+    lines = [' '.join(random_moves(rng, 25)), '']
+    for i in range(skeletons):
+        for j in range(rng.randint(1, 4)):
+            lines.append(' '.join(random_moves(rng, rng.randint(2, 8), 0.05)) + rng.choice(COMMENTS))
+        lines.append('')
+    return '\n'.join(lines)
+
+def write(directory, sizes, seed=0):
+    """ Writes one .fm file per size, returns their paths. """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for size in sizes:
+        path = os.path.join(directory, 'corpus_{}.fm'.format(size))
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(generate(size, seed))
+        paths.append(path)
+    return paths
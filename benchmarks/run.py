@@ -0,0 +1,258 @@
+""" Times the hot paths of the plugin on synthetic solution files, with
+    the sublime stub standing in for the editor.
+
+    python3 benchmarks/run.py                      # report only
+    python3 benchmarks/run.py --save               # store a new baseline
+    python3 benchmarks/run.py --compare            # fail on regressions
+"""
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import tracemalloc
+from statistics import median
+from time import perf_counter
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR = os.path.dirname(BENCHMARKS_DIR)
+BASELINE = os.path.join(BENCHMARKS_DIR, 'baseline.json')
+# time differences below this are noise, whatever the ratio
+NOISE = 0.002
+# seconds loading the plugin may take, whatever the baseline
+LOAD_BUDGET = 0.025
+
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, 'stub'))
+sys.path.insert(0, os.path.dirname(PACKAGE_DIR))
+
+import sublime
+import sublime_plugin
+import corpus
+
+def package_module(name):
+    # the package directory name may not be a valid identifier
+    return importlib.import_module(os.path.basename(PACKAGE_DIR) + '.' + name)
+
+move_transformer = package_module('move_transformer')
+facelet_cube = package_module('facelet_cube')
+document_module = package_module('document')
+fewest_moves = package_module('fewest_moves')
+draw_scramble = package_module('draw_scramble')
+step_solver = package_module('step_solver')
+cursor_state = package_module('cursor_state')
+
+def parse(text):
+    document = document_module.Document()
+    document.update(text)
+    return document
+
+def edited(text):
+    """ Returns the text with a move added to the middle line. """
+    lines = text.split('\n')
+    middle = len(lines) // 2
+    lines[middle] += ' R'
+    return '\n'.join(lines)
+
+# every benchmark takes the corpus text and returns a function doing the
+# timed work, anything done before that is setup
+
+def bench_tokenize(text):
+    return lambda: move_transformer.tokenize(text)
+
+def bench_normalize(text):
+    sequences = [' '.join(token[3] for token in block.tokens()) for block in parse(text).blocks()]
+    # bypass the lru_cache, repeated runs would only measure cache hits
+    normalize = move_transformer.normalize.__wrapped__
+    return lambda: [normalize(sequence) for sequence in sequences]
+
+def bench_facelet_apply(text):
+    document = parse(text)
+    scramble = document.scramble
+    skeletons = [block.skeleton for block in document.blocks()]
+    return lambda: [facelet_cube.FaceletCube(scramble).apply(skeleton) for skeleton in skeletons]
+
+def bench_document_parse(text):
+    return lambda: parse(text)
+
+def bench_count_moves(text):
+    view = sublime.View(text)
+    return lambda: fewest_moves.CountMovesCommand(view).run(None)
+
+def bench_count_moves_edit(text):
+    view = sublime.View(text)
+    fewest_moves.CountMovesCommand(view).run(None)
+    view.set_text(edited(text))
+    return lambda: fewest_moves.CountMovesCommand(view).run(None)
+
+def bench_find_duplicates(text):
+    view = sublime.View(text)
+    document = fewest_moves.get_document(view)
+    return lambda: fewest_moves.MoveCountCache(view).find_duplicates(document)
+
+def bench_session_restore(text):
+    """ Reopens a file saved with its session, up to the first refresh
+        with duplicates flagged. """
+    view = sublime.View(text)
+    view.path = os.path.join(BENCHMARKS_DIR, 'session.fm')
+    fewest_moves.find_duplicates(view)
+    fewest_moves.CountMovesCommand(view).run(None)
+    fewest_moves.save_session(view)
+    reopened = sublime.View(text)
+    reopened.path = view.path
+    def run():
+        fewest_moves.restore_session(reopened)
+        fewest_moves.find_duplicates(reopened)
+        fewest_moves.CountMovesCommand(reopened).run(None)
+    return run
+
+def drawing_view(text):
+    view = sublime.View(text)
+    # the scramble analysis runs on its own thread, timed on its own
+    view.settings().set('analyze_scramble', False)
+    return view
+
+def bench_draw_scramble(text):
+    view = drawing_view(text)
+    draw_scramble.scramble_html.cache_clear()
+    draw_scramble.state_html.cache_clear()
+    return lambda: draw_scramble.DrawScrambleCommand(view).run(None)
+
+def bench_draw_scramble_edit(text):
+    view = drawing_view(text)
+    draw_scramble.DrawScrambleCommand(view).run(None)
+    view.set_text(edited(text))
+    return lambda: draw_scramble.DrawScrambleCommand(view).run(None)
+
+def bench_cursor_state(text):
+    """ Moves the cursor over every token of the middle skeleton. """
+    view = sublime.View(text)
+    view.settings().set('show_cursor_state', True)
+    blocks = fewest_moves.get_document(view).blocks()
+    block = blocks[len(blocks) // 2]
+    points = [view.text_point(row, end) for row, begin, end, token in block.tokens()]
+    def run():
+        for point in points:
+            view.sel()[0] = sublime.Region(point)
+            cursor_state.DrawCursorStateCommand(view).run(None)
+    return run
+
+def bench_scramble_analysis(text):
+    state = facelet_cube.FaceletCube(parse(text).scramble).state
+    for step in step_solver.get_steps():
+        step.prepare(draw_scramble.get_pruning_tables())
+    return lambda: [step_solver.StepSearch(step, state).run() for step in step_solver.get_steps()]
+
+def bench_plugin_load(text):
+    """ Imports every module of the package again, as Sublime Text does
+        when it loads the plugin. The standard library stays loaded, as it
+        is in the editor. """
+    prefix = os.path.basename(PACKAGE_DIR) + '.'
+    names = sorted(name[:-3] for name in os.listdir(PACKAGE_DIR) if name.endswith('.py'))
+    loaded = {name: module for name, module in sys.modules.items() if name.startswith(prefix)}
+    commands = dict(sublime_plugin.text_commands)
+    for name in loaded:
+        del sys.modules[name]
+    def run():
+        for name in names:
+            package_module(name)
+        # the other benchmarks keep the modules they imported
+        sys.modules.update(loaded)
+        sublime_plugin.text_commands.update(commands)
+    return run
+
+BENCHMARKS = [
+    ('tokenize', bench_tokenize),
+    ('normalize', bench_normalize),
+    ('facelet_apply', bench_facelet_apply),
+    ('document_parse', bench_document_parse),
+    ('count_moves', bench_count_moves),
+    ('count_moves_edit', bench_count_moves_edit),
+    ('find_duplicates', bench_find_duplicates),
+    ('session_restore', bench_session_restore),
+    ('draw_scramble', bench_draw_scramble),
+    ('draw_scramble_edit', bench_draw_scramble_edit),
+    ('cursor_state', bench_cursor_state),
+    ('scramble_analysis', bench_scramble_analysis),
+    ('plugin_load', bench_plugin_load),
+]
+
+def measure(bench, text, repeat):
+    """ Returns the run times in seconds and the peak bytes allocated by
+        one more run. """
+    times = []
+    for i in range(repeat):
+        run = bench(text)
+        start = perf_counter()
+        run()
+        times.append(perf_counter() - start)
+    run = bench(text)
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return times, peak
+
+def compare(results, baseline, tolerance):
+    """ Returns the descriptions of results slower or bigger than the
+        baseline by more than the tolerance, and of plugin loads over
+        LOAD_BUDGET. """
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key.startswith('plugin_load[') and result['time'] > LOAD_BUDGET:
+            regressions.append('{} time: {:.4g} > budget {:.4g}'.format(key, result['time'], LOAD_BUDGET))
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if result['time'] > base['time'] * (1 + tolerance) and result['time'] - base['time'] > NOISE:
+            regressions.append('{} time: {:.4g} > {:.4g}'.format(key, result['time'], base['time']))
+        if result['peak'] > base['peak'] * (1 + tolerance):
+            regressions.append('{} peak: {} > {}'.format(key, result['peak'], base['peak']))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the plugin on synthetic solution files.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000], help='skeletons per corpus')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark, the fastest is kept')
+    parser.add_argument('--only', nargs='+', help='benchmarks to run')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic corpora')
+    parser.add_argument('--save', nargs='?', const=BASELINE, help='write the results as the baseline')
+    parser.add_argument('--compare', nargs='?', const=BASELINE, help='exit with 1 on regressions against the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown or growth over the baseline')
+    parser.add_argument('--write-corpus', metavar='DIR', help='only write the corpora as .fm files to DIR')
+    args = parser.parse_args(argv)
+    if args.write_corpus:
+        for path in corpus.write(args.write_corpus, args.sizes, args.seed):
+            print(path)
+        return 0
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    results = {}
+    print('{:<20} {:>6} {:>11} {:>11} {:>11} {:>9}'.format('benchmark', 'size', 'min ms', 'median ms', 'peak KiB', 'baseline'))
+    for size in args.sizes:
+        text = corpus.generate(size, args.seed)
+        for name, bench in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            times, peak = measure(bench, text, args.repeat)
+            key = '{}[{}]'.format(name, size)
+            results[key] = {'time': min(times), 'peak': peak}
+            ratio = ''
+            if key in baseline:
+                ratio = '{:.2f}x'.format(min(times) / baseline[key]['time'])
+            print('{:<20} {:>6} {:>11.3f} {:>11.3f} {:>11.1f} {:>9}'.format(name, size, min(times) * 1000, median(times) * 1000, peak / 1024, ratio))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.compare:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('regression:', regression)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+""" In-memory stand-in for the parts of the sublime module the plugin
+    uses, enough to run its commands outside the editor. """
+
+import os
+import tempfile
+import threading
+
+LAYOUT_INLINE = 0
+LAYOUT_BELOW = 1
+LAYOUT_BLOCK = 2
+CLASS_EMPTY_LINE = 512
+
+class Region:
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return self.end() - self.begin()
+
+    def empty(self):
+        return self.a == self.b
+
+    def __eq__(self, other):
+        return isinstance(other, Region) and (self.a, self.b) == (other.a, other.b)
+
+    def __repr__(self):
+        return 'Region({}, {})'.format(self.a, self.b)
+
+class Phantom:
+    def __init__(self, region, content, layout, on_navigate=None):
+        self.region = region
+        self.content = content
+        self.layout = layout
+        self.on_navigate = on_navigate
+        self.id = None
+
+    def __eq__(self, other):
+        return (self.region, self.content, self.layout) == (other.region, other.content, other.layout)
+
+class PhantomSet:
+    def __init__(self, view, key=''):
+        self.view = view
+        self.key = key
+        self.phantoms = []
+
+    def update(self, phantoms):
+        for phantom in phantoms:
+            try:
+                phantom.id = self.phantoms[self.phantoms.index(phantom)].id
+            except ValueError:
+                phantom.id = self.view.add_phantom(self.key, phantom.region, phantom.content, phantom.layout)
+        for phantom in self.phantoms:
+            if phantom not in phantoms:
+                self.view.erase_phantom_by_id(phantom.id)
+        self.phantoms = phantoms
+
+class Settings(dict):
+    def get(self, key, default=None):
+        return dict.get(self, key, default)
+
+    def set(self, key, value):
+        self[key] = value
+
+    def add_on_change(self, key, callback):
+        pass
+
+    def clear_on_change(self, key):
+        pass
+
+class View:
+    next_id = 0
+
+    def __init__(self, text='', visible_lines=60):
+        View.next_id += 1
+        self.view_id = View.next_id
+        self.text = text
+        self.visible_lines = visible_lines
+        self.first_visible_line = 0
+        self.view_settings = Settings()
+        self.phantoms = {}
+        self.next_phantom_id = 0
+        self.changes = 0
+        self.selection = [Region(0)]
+        self.status = {}
+        self.name = ''
+        self.path = None
+
+    def id(self):
+        return self.view_id
+
+    def settings(self):
+        return self.view_settings
+
+    def size(self):
+        return len(self.text)
+
+    def change_count(self):
+        return self.changes
+
+    def set_text(self, text):
+        self.text = text
+        self.changes += 1
+
+    def substr(self, region):
+        if isinstance(region, int):
+            return self.text[region:region + 1]
+        return self.text[region.begin():region.end()]
+
+    def line(self, region):
+        point = region if isinstance(region, int) else region.begin()
+        begin = self.text.rfind('\n', 0, point) + 1
+        end = self.text.find('\n', point)
+        return Region(begin, len(self.text) if end < 0 else end)
+
+    def rowcol(self, point):
+        row = self.text.count('\n', 0, point)
+        return row, point - (self.text.rfind('\n', 0, point) + 1)
+
+    def text_point(self, row, col):
+        point = 0
+        for i in range(row):
+            point = self.text.find('\n', point) + 1
+            if point == 0:
+                return len(self.text)
+        return point + col
+
+    def visible_region(self):
+        begin = self.text_point(self.first_visible_line, 0)
+        end = self.text_point(self.first_visible_line + self.visible_lines, 0)
+        return Region(begin, end)
+
+    def scope_name(self, point):
+        return 'source.fm '
+
+    def match_selector(self, point, selector):
+        return selector in self.scope_name(point)
+
+    def sel(self):
+        return self.selection
+
+    def add_phantom(self, key, region, content, layout, on_navigate=None):
+        self.next_phantom_id += 1
+        self.phantoms[self.next_phantom_id] = (key, region, content, layout)
+        return self.next_phantom_id
+
+    def erase_phantom_by_id(self, phantom_id):
+        self.phantoms.pop(phantom_id, None)
+
+    def erase_phantoms(self, key):
+        for phantom_id in [phantom_id for phantom_id, phantom in self.phantoms.items() if phantom[0] == key]:
+            del self.phantoms[phantom_id]
+
+    def set_status(self, key, value):
+        self.status[key] = value
+
+    def erase_status(self, key):
+        self.status.pop(key, None)
+
+    def is_loading(self):
+        return False
+
+    def file_name(self):
+        return self.path
+
+    def window(self):
+        return active_window()
+
+    def set_scratch(self, scratch):
+        pass
+
+    def set_name(self, name):
+        self.name = name
+
+    def set_read_only(self, read_only):
+        pass
+
+    def insert(self, edit, point, text):
+        self.set_text(self.text[:point] + text + self.text[point:])
+        return len(text)
+
+    def run_command(self, name, args=None):
+        import sublime_plugin
+        return sublime_plugin.text_commands[name](self).run(None, **(args or {}))
+
+class Window:
+    def __init__(self):
+        self.views = []
+
+    def new_file(self):
+        view = View()
+        self.views.append(view)
+        return view
+
+    def active_view(self):
+        return self.views[-1] if self.views else None
+
+default_window = Window()
+
+def active_window():
+    return default_window
+
+def windows():
+    return [default_window]
+
+def set_timeout(callback, delay=0):
+    timer = threading.Timer(delay / 1000, callback)
+    timer.daemon = True
+    timer.start()
+
+set_timeout_async = set_timeout
+
+def error_message(message):
+    print('error:', message)
+
+def status_message(message):
+    pass
+
+def load_settings(name):
+    return Settings()
+
+def cache_path():
+    return os.path.join(tempfile.gettempdir(), 'sublime_stub_cache')
+
+def version():
+    return '4000'
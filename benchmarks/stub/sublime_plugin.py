@@ -0,0 +1,36 @@
+""" Stand-in for sublime_plugin, commands are registered under the names
+    Sublime Text derives from their class names. """
+
+import re
+
+text_commands = {}
+
+def command_name(cls):
+    name = cls.__name__
+    if name.endswith('Command'):
+        name = name[:-len('Command')]
+    return re.sub(r'(?<!^)([A-Z])', r'_\1', name).lower()
+
+class CommandType(type):
+    def __init__(cls, name, bases, attributes):
+        type.__init__(cls, name, bases, attributes)
+        if bases:
+            text_commands[command_name(cls)] = cls
+
+class TextCommand(metaclass=CommandType):
+    def __init__(self, view):
+        self.view = view
+
+class WindowCommand:
+    def __init__(self, window):
+        self.window = window
+
+class ApplicationCommand:
+    pass
+
+class EventListener:
+    pass
+
+class ViewEventListener:
+    def __init__(self, view):
+        self.view = view
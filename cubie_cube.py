@@ -0,0 +1,223 @@
+from array import array
+from threading import Lock
+from .move_transformer import tokenize, parse_move
+from .facelet_cube import FaceletCube, SOLVED, MOVE_TABLES
+from .cycle_analyzer import CORNER_FACELETS, EDGE_FACELETS, CORNER_LOOKUP, EDGE_LOOKUP, cubies, count_cycles
+
+# every corner is stored as piece * 3 + twist and every edge as
+# piece * 2 + flip, one byte each, in the slot order of CORNER_FACELETS
+# and EDGE_FACELETS
+
+# TWIST_CORNER[value][twist] adds a twist to a stored corner, same for edges
+TWIST_CORNER = [[value - value % 3 + (value + twist) % 3 for twist in range(3)] for value in range(24)]
+FLIP_EDGE = [[value ^ flip for flip in range(2)] for value in range(24)]
+
+SOLVED_CORNERS = bytes(piece * 3 for piece in range(8))
+SOLVED_EDGES = bytes(piece * 2 for piece in range(12))
+
+# edges of the E slice, FR FL BL BR
+SLICE_EDGES = (8, 9, 10, 11)
+
+def binomial(n, k):
+    if k < 0 or k > n:
+        return 0
+    result = 1
+    for i in range(k):
+        result = result * (n - i) // (i + 1)
+    return result
+
+def permutation_index(permutation):
+    """ Lehmer code of a permutation, 0 for the identity. """
+    index = 0
+    for i in range(len(permutation)):
+        smaller = 0
+        for j in range(i + 1, len(permutation)):
+            if permutation[j] < permutation[i]:
+                smaller += 1
+        index = index * (len(permutation) - i) + smaller
+    return index
+
+class CubieCube:
+    """ Corner and edge permutation and orientation of a cube, centers
+        and whole cube rotations are left out. Instances are immutable
+        and hashable. Composition follows FaceletCube: a * b applies a's
+        moves, then b's. """
+
+    __slots__ = ('corners', 'edges')
+
+    def __init__(self, corners=SOLVED_CORNERS, edges=SOLVED_EDGES):
+        self.corners = corners
+        self.edges = edges
+
+    @classmethod
+    def from_facelet(cls, cube):
+        corners, twists = cubies(cube.state, CORNER_FACELETS, CORNER_LOOKUP)
+        edges, flips = cubies(cube.state, EDGE_FACELETS, EDGE_LOOKUP)
+        return cls(bytes(piece * 3 + twist for piece, twist in zip(corners, twists)), bytes(piece * 2 + flip for piece, flip in zip(edges, flips)))
+
+    @classmethod
+    def from_scramble(cls, scramble):
+        return cls().apply(scramble)
+
+    def to_facelet(self):
+        state = bytearray(SOLVED)
+        for pieces, values, modulus in ((CORNER_FACELETS, self.corners, 3), (EDGE_FACELETS, self.edges, 2)):
+            for slot, value in enumerate(values):
+                piece, twist = divmod(value, modulus)
+                for k in range(modulus):
+                    state[pieces[slot][k]] = pieces[piece][(k + twist) % modulus]
+        return FaceletCube(state=bytes(state))
+
+    def permutation(self):
+        """ Returns (corner pieces, corner twists, edge pieces, edge flips)
+            by slot. """
+        return ([value // 3 for value in self.corners], [value % 3 for value in self.corners],
+                [value // 2 for value in self.edges], [value % 2 for value in self.edges])
+
+    def __mul__(self, other):
+        corners = self.corners
+        edges = self.edges
+        return CubieCube(
+            bytes([TWIST_CORNER[corners[value // 3]][value % 3] for value in other.corners]),
+            bytes([FLIP_EDGE[edges[value >> 1]][value & 1] for value in other.edges]))
+
+    def move(self, code):
+        """ Returns the cube after a move code, axis * 3 + amount - 1. """
+        return self * MOVE_CUBES[code]
+
+    def apply(self, scramble):
+        cube = self
+        for move in tokenize(scramble):
+            axis, amount = parse_move(move)
+            cube = cube * MOVE_CUBES[axis * 3 + amount - 1]
+        return cube
+
+    def inverse(self):
+        corners = bytearray(8)
+        edges = bytearray(12)
+        for slot, value in enumerate(self.corners):
+            corners[value // 3] = slot * 3 + (3 - value % 3) % 3
+        for slot, value in enumerate(self.edges):
+            edges[value >> 1] = slot * 2 + (value & 1)
+        return CubieCube(bytes(corners), bytes(edges))
+
+    def is_solved(self):
+        return self.corners == SOLVED_CORNERS and self.edges == SOLVED_EDGES
+
+    def cycles(self):
+        """ Same fields as cycle_analyzer.analyze_cube, without centers. """
+        corners, twists, edges, flips = self.permutation()
+        cornerCycles, parity = count_cycles(corners, twists, 3)
+        edgeCycles, edgeParity = count_cycles(edges, flips, 2)
+        return {
+            'corner_cycles': cornerCycles,
+            'edge_cycles': edgeCycles,
+            'center_cycles': 0,
+            'parity': parity,
+        }
+
+    # coordinates, as small integers
+
+    def twist(self):
+        """ Corner orientation, 0 to 3 ** 7 - 1. """
+        twist = 0
+        for value in self.corners[:7]:
+            twist = twist * 3 + value % 3
+        return twist
+
+    def flip(self):
+        """ Edge orientation, 0 to 2 ** 11 - 1. """
+        flip = 0
+        for value in self.edges[:11]:
+            flip = flip * 2 + (value & 1)
+        return flip
+
+    def slice(self):
+        """ Slots of the E slice edges, 0 to 494, 0 when they are home. """
+        index = 0
+        found = 0
+        for slot in range(11, -1, -1):
+            if self.edges[slot] >> 1 in SLICE_EDGES:
+                index += binomial(11 - slot, found + 1)
+                found += 1
+        return index
+
+    def corner_permutation(self):
+        return permutation_index([value // 3 for value in self.corners])
+
+    def edge_permutation(self):
+        return permutation_index([value >> 1 for value in self.edges])
+
+    @classmethod
+    def from_twist(cls, twist):
+        corners = bytearray(SOLVED_CORNERS)
+        total = 0
+        for slot in range(6, -1, -1):
+            twist, corners[slot] = divmod(twist, 3)
+            corners[slot] += slot * 3
+            total += corners[slot] % 3
+        corners[7] = 7 * 3 + (3 - total % 3) % 3
+        return cls(bytes(corners), SOLVED_EDGES)
+
+    @classmethod
+    def from_flip(cls, flip):
+        edges = bytearray(SOLVED_EDGES)
+        total = 0
+        for slot in range(10, -1, -1):
+            flip, bit = divmod(flip, 2)
+            edges[slot] = slot * 2 + bit
+            total += bit
+        edges[11] = 11 * 2 + total % 2
+        return cls(SOLVED_CORNERS, bytes(edges))
+
+    @classmethod
+    def from_slice(cls, index):
+        """ A cube whose slice coordinate is index, the other edges in
+            order. """
+        occupied = [False] * 12
+        left = 4
+        for slot in range(12):
+            if left and index >= binomial(11 - slot, left):
+                index -= binomial(11 - slot, left)
+                occupied[slot] = True
+                left -= 1
+        slices = iter(SLICE_EDGES)
+        others = iter([piece for piece in range(12) if piece not in SLICE_EDGES])
+        edges = bytes((next(slices) if occupied[slot] else next(others)) * 2 for slot in range(12))
+        return cls(SOLVED_CORNERS, edges)
+
+    def __eq__(self, other):
+        return isinstance(other, CubieCube) and self.corners == other.corners and self.edges == other.edges
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.corners, self.edges))
+
+    def __repr__(self):
+        return 'CubieCube({!r}, {!r})'.format(self.corners, self.edges)
+
+MOVE_CUBES = [CubieCube.from_facelet(FaceletCube(state=table)) for table in MOVE_TABLES]
+
+move_tables = {}
+move_tables_lock = Lock()
+
+def coordinate_move_table(name):
+    """ Returns the move table of the twist, flip or slice coordinate,
+        table[coordinate * 18 + code] being the coordinate after the move.
+        Tables are built once, on first use. """
+    with move_tables_lock:
+        table = move_tables.get(name)
+        if table is None:
+            size, build, read = {
+                'twist': (3 ** 7, CubieCube.from_twist, CubieCube.twist),
+                'flip': (2 ** 11, CubieCube.from_flip, CubieCube.flip),
+                'slice': (binomial(12, 4), CubieCube.from_slice, CubieCube.slice),
+            }[name]
+            table = array('H')
+            for coordinate in range(size):
+                cube = build(coordinate)
+                table.extend([read(cube * move) for move in MOVE_CUBES])
+            move_tables[name] = table
+        return table
@@ -0,0 +1,188 @@
+import sublime
+import sublime_plugin
+from collections import OrderedDict
+from .facelet_cube import FaceletCube, MOVE_TABLES, SOLVED, gather
+from .cycle_analyzer import CENTER_FACELETS
+from .move_transformer import token_codes
+from .symmetry import SYMMETRY_TABLES
+from .fewest_moves import is_fewest_moves, get_document
+from .draw_scramble import FACE_COLORS, state_html
+from .instrumentation import timed
+
+# states are checkpointed every this many moves, reaching the cursor
+# replays fewer moves than that
+CHECKPOINT_INTERVAL = 8
+# blocks whose checkpoints are kept for each view
+CACHED_BLOCKS = 16
+
+def inverse_state(state):
+    inverse = bytearray(54)
+    for position, facelet in enumerate(state):
+        inverse[facelet] = position
+    return bytes(inverse)
+
+def rotation_table(axis):
+    """ Returns the permutation of the whole cube turning like the face
+        turn of an axis, y, x and z for U, R and F. """
+    table = MOVE_TABLES[axis * 3]
+    moves = [(table[facelet], facelet) for facelet in range(54) if table[facelet] != facelet]
+    for symmetry in SYMMETRY_TABLES:
+        if all(symmetry[source] == target for source, target in moves):
+            return inverse_state(symmetry)
+
+# CODE_TABLES[code] is the permutation of a move code of token_codes,
+# face turns and then rotations
+CODE_TABLES = list(MOVE_TABLES)
+for axis in range(3):
+    table = rotation_table(axis)
+    turn = table
+    for amount in range(3):
+        CODE_TABLES.append(turn)
+        turn = gather(turn, table)
+
+# the symmetry undoing the whole cube rotation read from the centers
+UNROTATIONS = {}
+for table in SYMMETRY_TABLES:
+    inverse = inverse_state(table)
+    UNROTATIONS[bytes(inverse[center] for center in CENTER_FACELETS)] = table
+
+token_tables = {}
+
+def token_table(token):
+    table = token_tables.get(token)
+    if table is None:
+        table = SOLVED
+        for code in token_codes(token):
+            table = gather(table, CODE_TABLES[code])
+        token_tables[token] = table
+    return table
+
+def checkpoints(start, tables):
+    """ Returns the states after every CHECKPOINT_INTERVAL tables. """
+    states = [start]
+    state = start
+    for index, table in enumerate(tables):
+        state = gather(state, table)
+        if (index + 1) % CHECKPOINT_INTERVAL == 0:
+            states.append(state)
+    return states
+
+def replay(states, tables, count):
+    """ Returns the state after count tables from the checkpoints. """
+    first = count - count % CHECKPOINT_INTERVAL
+    state = states[first // CHECKPOINT_INTERVAL]
+    for table in tables[first:count]:
+        state = gather(state, table)
+    return state
+
+class BlockStates:
+    """ Cube states reached after the scramble and the first tokens of a
+        block, segments being (inverse, tokens) as Block.segments returns
+        them. As in normalize, inverse segments are applied inverted and
+        in reverse order after the other ones. Rotations and wide moves
+        turn the whole cube, which is turned back at the end. """
+
+    def __init__(self, scramble, segments):
+        normal = []
+        inverse = []
+        # numbers of normal and inverse moves among the first tokens
+        self.counts = [(0, 0)]
+        for inverted, tokens in segments:
+            tables = inverse if inverted else normal
+            for token in tokens:
+                tables.append(token_table(token))
+                self.counts.append((len(normal), len(inverse)))
+        self.normal = normal
+        self.inverse = inverse
+        self.normal_states = checkpoints(FaceletCube(scramble).state, normal)
+        self.inverse_states = checkpoints(SOLVED, inverse)
+
+    def state(self, count):
+        """ Returns the state after the first count tokens. """
+        normal, inverse = self.counts[count]
+        state = replay(self.normal_states, self.normal, normal)
+        if inverse:
+            state = gather(state, inverse_state(replay(self.inverse_states, self.inverse, inverse)))
+        return gather(state, UNROTATIONS[bytes(state[center] for center in CENTER_FACELETS)])
+
+# checkpoints of the blocks the cursor was last in, by view
+block_states = {}
+# block and state last drawn in each view
+drawn_states = {}
+
+def get_block_states(view, scramble, segments):
+    cache = block_states.get(view.id())
+    if cache is None:
+        cache = block_states[view.id()] = OrderedDict()
+    key = (scramble, segments)
+    states = cache.get(key)
+    if states is None:
+        states = cache[key] = BlockStates(scramble, segments)
+        if len(cache) > CACHED_BLOCKS:
+            cache.popitem(False)
+    else:
+        cache.move_to_end(key)
+    return states
+
+def forget_states(view):
+    block_states.pop(view.id(), None)
+    drawn_states.pop(view.id(), None)
+
+class DrawCursorStateCommand(sublime_plugin.TextCommand):
+    """ Shows the cube after the scramble and the moves of the skeleton
+        before the cursor, below that skeleton. """
+
+    def run(self, edit):
+        with timed('cursor_state'):
+            self.draw()
+
+    def draw(self):
+        view = self.view
+        settings = view.settings()
+        selection = view.sel()
+        block = None
+        if settings.get('show_cursor_state', False) and len(selection) > 0:
+            row, col = view.rowcol(selection[0].b)
+            document = get_document(view)
+            block = document.block_at(row)
+        if block is None or block.first == 0:
+            drawn_states.pop(view.id(), None)
+            view.erase_phantoms('cursor_state')
+            return
+        segments = []
+        count = 0
+        for inverted, tokens in block.segments():
+            for line, begin, end, token in tokens:
+                if line < row or (line == row and end <= col):
+                    count += 1
+            segments.append((inverted, tuple(token[3] for token in tokens)))
+        state = get_block_states(view, document.scramble, tuple(segments)).state(count)
+        colors = tuple(settings.get(name, default) for name, default in FACE_COLORS)
+        key = (block.last, state, colors)
+        if drawn_states.get(view.id()) == key:
+            return
+        drawn_states[view.id()] = key
+        view.erase_phantoms('cursor_state')
+        begin = document.offsets[block.last]
+        lastLine = sublime.Region(begin, begin + len(document.lines[block.last].text))
+        view.add_phantom('cursor_state', lastLine, state_html(state, colors), sublime.LAYOUT_BLOCK)
+
+    def is_enabled(self):
+        return is_fewest_moves(self.view)
+
+class ToggleCursorStateCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        settings = self.view.settings()
+        settings.set('show_cursor_state', not settings.get('show_cursor_state', False))
+        self.view.run_command('draw_cursor_state')
+
+    def is_enabled(self):
+        return is_fewest_moves(self.view)
+
+class CursorStateEventListener(sublime_plugin.EventListener):
+    def on_selection_modified_async(self, view):
+        if view.settings().get('show_cursor_state', False) and is_fewest_moves(view):
+            view.run_command('draw_cursor_state')
+
+    def on_close(self, view):
+        forget_states(view)
@@ -0,0 +1,121 @@
+from .facelet_cube import FaceletCube
+
+# facelets of each corner and edge slot, U/D (or F/B for E-slice edges)
+# sticker first, corners URF UFL ULB UBR DFR DLF DBL DRB and edges
+# UR UF UL UB DR DF DL DB FR FL BL BR
+CORNER_FACELETS = [
+    (8, 9, 20), (6, 18, 38), (0, 36, 47), (2, 45, 11),
+    (29, 26, 15), (27, 44, 24), (33, 53, 42), (35, 17, 51),
+]
+EDGE_FACELETS = [
+    (5, 10), (7, 19), (3, 37), (1, 46),
+    (32, 16), (28, 25), (30, 43), (34, 52),
+    (23, 12), (21, 41), (50, 39), (48, 14),
+]
+CENTER_FACELETS = [4, 13, 22, 31, 40, 49]
+
+def piece_lookup(pieces):
+    lookup = {}
+    for piece, facelets in enumerate(pieces):
+        for orientation, facelet in enumerate(facelets):
+            lookup[facelet] = (piece, orientation)
+    return lookup
+
+CORNER_LOOKUP = piece_lookup(CORNER_FACELETS)
+EDGE_LOOKUP = piece_lookup(EDGE_FACELETS)
+
+def cubies(state, pieces, lookup):
+    """ Returns the piece in every slot and its orientation, read from a
+        FaceletCube state. """
+    permutation = []
+    orientation = []
+    for facelets in pieces:
+        piece, twist = lookup[state[facelets[0]]]
+        permutation.append(piece)
+        orientation.append(twist)
+    return permutation, orientation
+
+def count_cycles(permutation, orientation, modulus):
+    """ Counts the 3-cycles needed to solve one kind of pieces.
+
+        Returns (cycles, parity). Odd-length permutation cycles are paired
+        up, a left over transposition is reported as parity. Cycles with a
+        net twist or flip are grouped so that their orientations cancel,
+        and every group costs one extra 3-cycle, or two when it is made of
+        twisted pieces alone. """
+    visited = [False] * len(permutation)
+    cycles = 0
+    even = 0
+    twisted = [[] for i in range(modulus)]
+    for start in range(len(permutation)):
+        if visited[start]:
+            continue
+        length = 0
+        twist = 0
+        piece = start
+        while not visited[piece]:
+            visited[piece] = True
+            length += 1
+            twist += orientation[piece]
+            piece = permutation[piece]
+        twist %= modulus
+        cycles += (length - 1) // 2
+        if length % 2 == 0:
+            even += 1
+        elif twist:
+            twisted[twist].append(length)
+    cycles += even // 2 * 2
+    groups = []
+    if modulus == 3:
+        ones = sorted(twisted[1], reverse=True)
+        twos = sorted(twisted[2])
+        pairs = min(len(ones), len(twos))
+        groups += [[ones[i], twos[i]] for i in range(pairs)]
+        rest = ones[pairs:] + twos[pairs:]
+        groups += [rest[i:i + 3] for i in range(0, len(rest), 3)]
+    elif modulus == 2:
+        rest = sorted(twisted[1])
+        while len(rest) > 1:
+            groups.append([rest.pop(), rest.pop(0)])
+        if rest:
+            groups.append(rest)
+    for group in groups:
+        cycles += 2 if max(group) == 1 else 1
+    return cycles, even % 2 == 1
+
+def analyze_cube(cube):
+    state = cube.state
+    corners, cornerTwists = cubies(state, CORNER_FACELETS, CORNER_LOOKUP)
+    edges, edgeFlips = cubies(state, EDGE_FACELETS, EDGE_LOOKUP)
+    centers = [CENTER_FACELETS.index(state[facelet]) for facelet in CENTER_FACELETS]
+    cornerCycles, parity = count_cycles(corners, cornerTwists, 3)
+    edgeCycles, edgeParity = count_cycles(edges, edgeFlips, 2)
+    centerCycles, centerParity = count_cycles(centers, [0] * 6, 1)
+    return {
+        'corner_cycles': cornerCycles,
+        'edge_cycles': edgeCycles,
+        'center_cycles': centerCycles,
+        'parity': parity,
+    }
+
+def analyze(scramble, skeleton):
+    """ Same fields as the output of `insertionfinder -v --json`, for
+        normalized scramble and skeleton sequences. """
+    return analyze_cube(FaceletCube(scramble).apply(skeleton))
+
+def total_cycles(result):
+    total = result['corner_cycles'] + result['edge_cycles'] + result['center_cycles']
+    if result['parity']:
+        total += 1
+    return total
+
+def describe(result):
+    """ Short description of an analysis, like 3c2e. """
+    if not total_cycles(result):
+        return 'solved'
+    text = '{}c{}e'.format(result['corner_cycles'], result['edge_cycles'])
+    if result['center_cycles']:
+        text += '{}x'.format(result['center_cycles'])
+    if result['parity']:
+        text += ', parity'
+    return text
@@ -0,0 +1,184 @@
+import re
+from bisect import bisect_right
+from threading import Lock
+from .move_transformer import move_pattern, normalize
+
+comment_pattern = re.compile(r'(?://|#).*')
+
+class Line:
+    """ A line of a solution file split into tokens, tokens are
+        (begin, end, text) with offsets from the start of the line. """
+
+    __slots__ = ('text', 'code', 'tokens', 'count')
+
+    def __init__(self, text):
+        self.text = text
+        comment = comment_pattern.search(text)
+        self.code = text[:comment.start()] if comment is not None else text
+        self.tokens = [(match.start(), match.end(), match.group()) for match in move_pattern.finditer(self.code)]
+        # rotations, [u] style rotations and NISS aren't moves
+        self.count = len([token for begin, end, token in self.tokens if token[:1] in 'URFDLB2'])
+
+    @property
+    def empty(self):
+        return self.code == ''
+
+class Block:
+    """ Consecutive non-empty lines, first and last being line indices. """
+
+    def __init__(self, document, first, last):
+        self.document = document
+        self.first = first
+        self.last = last
+        self.total = sum(line.count for line in document.lines[first:last + 1])
+        self._skeleton = None
+
+    def tokens(self):
+        """ Yields (line index, begin, end, text) of every token. """
+        for row in range(self.first, self.last + 1):
+            for begin, end, token in self.document.lines[row].tokens:
+                yield row, begin, end, token
+
+    def segments(self):
+        """ Returns the tokens split at NISS operators as a list of
+            (inverse, tokens). """
+        segments = [(False, [])]
+        for token in self.tokens():
+            if token[3].upper() == 'NISS':
+                segments.append((not segments[-1][0], []))
+            else:
+                segments[-1][1].append(token)
+        return [segment for segment in segments if segment[1]]
+
+    @property
+    def moves(self):
+        """ The moves of the block as typed, NISS included. """
+        return ' '.join(token[3] for token in self.tokens())
+
+    @property
+    def skeleton(self):
+        """ The normalized sequence of the block. """
+        if self._skeleton is None:
+            skeletons = self.document.skeletons
+            moves = self.moves
+            skeleton = skeletons.get(moves)
+            if skeleton is None:
+                skeleton = normalize(moves)
+                with self.document.skeletons_lock:
+                    skeletons[moves] = skeleton
+            self._skeleton = skeleton
+        return self._skeleton
+
+class Document:
+    """ Parsed lines and blocks of a solution file. update only lexes the
+        lines that changed since the previous text, updated does the same
+        into a new document and leaves this one alone. """
+
+    def __init__(self):
+        self.lines = []
+        self.change_count = None
+        self._blocks = None
+        self._firsts = None
+        self._offsets = None
+        self._scramble = None
+        # normalized sequences by the moves of a block, blocks are
+        # recreated on every change but most of them keep their moves
+        self.skeletons = {}
+        # taken to add to the skeletons and to copy them, any thread may
+        # read the skeletons of a document
+        self.skeletons_lock = Lock()
+
+    def update(self, text):
+        texts = text.split('\n')
+        old = self.lines
+        start = 0
+        limit = min(len(old), len(texts))
+        while start < limit and old[start].text == texts[start]:
+            start += 1
+        oldEnd = len(old)
+        newEnd = len(texts)
+        while oldEnd > start and newEnd > start and old[oldEnd - 1].text == texts[newEnd - 1]:
+            oldEnd -= 1
+            newEnd -= 1
+        if start == oldEnd and start == newEnd:
+            return
+        self.lines[start:oldEnd] = [Line(line) for line in texts[start:newEnd]]
+        self._blocks = None
+        self._offsets = None
+        if start == 0:
+            self._scramble = None
+
+    def updated(self, text):
+        """ Returns a new document of text sharing the unchanged lines. """
+        document = Document()
+        document.lines = self.lines[:]
+        document._scramble = self._scramble
+        document.skeletons = self.skeletons
+        document.skeletons_lock = self.skeletons_lock
+        document.update(text)
+        return document
+
+    def copy_skeletons(self):
+        with self.skeletons_lock:
+            return dict(self.skeletons)
+
+    def add_skeletons(self, skeletons):
+        with self.skeletons_lock:
+            self.skeletons.update(skeletons)
+
+    def text(self):
+        return '\n'.join(line.text for line in self.lines)
+
+    @property
+    def scramble(self):
+        """ The normalized scramble on the first line. """
+        if self._scramble is None:
+            self._scramble = normalize(' '.join(token for begin, end, token in self.lines[0].tokens)) if self.lines else ''
+        return self._scramble
+
+    @property
+    def offsets(self):
+        """ Offset of the start of every line in the text. """
+        if self._offsets is None:
+            offsets = []
+            position = 0
+            for line in self.lines:
+                offsets.append(position)
+                position += len(line.text) + 1
+            self._offsets = offsets
+        return self._offsets
+
+    def all_blocks(self):
+        """ Returns every run of non-empty lines, the scramble included. """
+        if self._blocks is None:
+            blocks = []
+            first = None
+            for row, line in enumerate(self.lines):
+                if line.empty:
+                    if first is not None:
+                        blocks.append(Block(self, first, row - 1))
+                        first = None
+                elif first is None:
+                    first = row
+            if first is not None:
+                blocks.append(Block(self, first, len(self.lines) - 1))
+            self._blocks = blocks
+            self._firsts = [block.first for block in blocks]
+            # forget the skeletons of edited blocks once they outnumber
+            # the blocks
+            if len(self.skeletons) > 2 * len(blocks):
+                skeletons = self.skeletons
+                self.skeletons = {moves: skeletons[moves] for moves in (block.moves for block in blocks) if moves in skeletons}
+        return self._blocks
+
+    def blocks(self):
+        """ Returns the blocks that hold moves after the scramble line. """
+        return [block for block in self.all_blocks() if block.last > 0 and block.total > 0]
+
+    def block_at(self, row):
+        """ Returns the block containing a line, None on empty lines. """
+        blocks = self.all_blocks()
+        index = bisect_right(self._firsts, row) - 1
+        if index >= 0 and row <= blocks[index].last:
+            return blocks[index]
+        return None
@@ -1,8 +1,153 @@
 import sublime
 import sublime_plugin
+import os
 import random
+import traceback
+from functools import lru_cache
+from collections import OrderedDict
+from html import escape
+from threading import Thread, Lock
+from time import time
 from .facelet_cube import FaceletCube
-from .fewest_moves import is_fewest_moves, get_scramble
+# Sublime Text loads fewest_moves as a plugin of its own, importing it
+# here again only looks it up
+from .fewest_moves import is_fewest_moves, get_scramble, session_parts, CountMovesCommand
+from .instrumentation import timed
+from .step_solver import PruningTables, StepSearch, get_steps
+
+# settings and default colors of the faces, in URFDLB order
+FACE_COLORS = [
+    ('u_face', '#ffffff'),
+    ('r_face', '#ff0000'),
+    ('f_face', '#00ff00'),
+    ('d_face', '#ffff00'),
+    ('l_face', '#ff8000'),
+    ('b_face', '#0000ff'),
+]
+
+# facelet shown in each cell of the unfolded cube, None for gaps
+LAYOUT = []
+for row in range(9):
+    cells = []
+    for col in range(12):
+        if (row < 3 or row >= 6) and (col < 3 or col >= 6):
+            cells.append(None)
+        elif row < 3:
+            cells.append(0 * 9 + row * 3 + col - 3)
+        elif row >= 6:
+            cells.append(3 * 9 + (row - 6) * 3 + col - 3)
+        else:
+            # L F R B from left to right
+            face = [4, 2, 1, 5][col // 3]
+            cells.append(face * 9 + (row - 3) * 3 + col % 3)
+    LAYOUT.append(cells)
+
+# scramble and colors last drawn in each view
+drawn_scrambles = {}
+# running analysis of the scramble of each view
+scramble_analyses = {}
+# lines of the analyses that finished every step, by scramble
+finished_analyses = OrderedDict()
+finished_lock = Lock()
+FINISHED_ANALYSES = 16
+pruning_tables = None
+
+def get_pruning_tables():
+    global pruning_tables
+    if pruning_tables is None:
+        pruning_tables = PruningTables(os.path.join(sublime.cache_path(), 'Fewest Moves', 'tables'))
+    return pruning_tables
+
+def remember_analysis(scramble, lines):
+    with finished_lock:
+        finished_analyses[scramble] = lines
+        finished_analyses.move_to_end(scramble)
+        if len(finished_analyses) > FINISHED_ANALYSES:
+            finished_analyses.popitem(False)
+
+def steps_html(lines):
+    text = '<br>'.join(escape(line, False) for line in lines)
+    return CountMovesCommand.HTML_TEMPLATE.format(foreground='#7f7c6a', font_style='italic', padding=0, text=text)
+
+def draw_steps(view, html):
+    view.erase_phantoms('scramble_steps')
+    firstLine = view.line(sublime.Region(0, 0))
+    view.add_phantom('scramble_steps', firstLine, html, sublime.LAYOUT_BLOCK)
+
+def describe_step(name, length, solutions, complete):
+    if not solutions:
+        return '{}: {}+ moves{}'.format(name, length, '' if complete else ', out of time')
+    moves = ', '.join('{} [{}]'.format(moves or 'solved', variant) for variant, moves in solutions)
+    return ('{} ({} move): {}' if length == 1 else '{} ({} moves): {}').format(name, length, moves)
+
+class ScrambleAnalysis(Thread):
+    """ Finds optimal solutions of every step of a scramble, one step
+        after the other, and shows them below the scramble diagram as they
+        come. Every step gets time_limit seconds. """
+
+    def __init__(self, view, scramble, time_limit):
+        Thread.__init__(self)
+        self.daemon = True
+        self.view = view
+        self.scramble = scramble
+        self.time_limit = time_limit
+        self.cancelled = False
+        self.lines = ['{}: searching...'.format(step.name) for step in get_steps()]
+        self.complete = True
+
+    def run(self):
+        try:
+            state = FaceletCube(self.scramble).state
+            self.show()
+            for index, step in enumerate(get_steps()):
+                # the first use of a step builds its tables
+                step.prepare(get_pruning_tables())
+                if self.cancelled:
+                    return
+                with timed('scramble_analysis'):
+                    length, solutions, complete = StepSearch(step, state, time() + self.time_limit, lambda: self.cancelled).run()
+                if self.cancelled:
+                    return
+                self.lines[index] = describe_step(step.name, length, solutions, complete)
+                self.complete = self.complete and complete
+                self.show()
+            # analyses cut short by the time limit are searched again
+            if self.complete:
+                remember_analysis(self.scramble, list(self.lines))
+        except Exception:
+            traceback.print_exc()
+
+    def show(self):
+        html = steps_html(self.lines)
+        sublime.set_timeout(lambda: self.draw(html), 0)
+
+    def draw(self, html):
+        if not self.cancelled:
+            draw_steps(self.view, html)
+
+    def cancel(self):
+        self.cancelled = True
+
+def cancel_analysis(view):
+    analysis = scramble_analyses.pop(view.id(), None)
+    if analysis is not None:
+        analysis.cancel()
+
+@lru_cache(maxsize=64)
+def scramble_html(scramble, colors):
+    """ Returns the phantom showing the state of a normalized scramble. """
+    return state_html(FaceletCube(scramble).state, colors)
+
+@lru_cache(maxsize=64)
+def state_html(state, colors):
+    """ Returns the phantom showing a FaceletCube state. """
+    facelets = FaceletCube(state=state).colors()
+    FACELETS = 'urfdlb'
+    rowTemplate = '<div class="row">{}</div>'
+    spanTemplate = '<span class="cell {}">■</span>'
+    rows = ''.join([rowTemplate.format(''.join([spanTemplate.format('gap' if idx is None else FACELETS[facelets[idx]]) for idx in cells])) for cells in LAYOUT])
+    colorU, colorR, colorF, colorD, colorL, colorB = colors
+    return DrawScrambleCommand.HTML_TEMPLATE.format(rows=rows, colorU=colorU, colorR=colorR, colorF=colorF, colorD=colorD, colorL=colorL, colorB=colorB)
 
 class DrawScrambleCommand(sublime_plugin.TextCommand):
 
@@ -67,57 +212,55 @@ class DrawScrambleCommand(sublime_plugin.TextCommand):
     """
 
     def run(self, edit):
+        with timed('draw_scramble'):
+            self.draw()
+
+    def draw(self):
         view = self.view
         settings = view.settings()
-        colorU = settings.get('u_face', '#ffffff')
-        colorR = settings.get('r_face', '#ff0000')
-        colorF = settings.get('f_face', '#00ff00')
-        colorD = settings.get('d_face', '#ffff00')
-        colorL = settings.get('l_face', '#ff8000')
-        colorB = settings.get('b_face', '#0000ff')
-        view.erase_phantoms('scramble_state')
-        firstLine = view.line(sublime.Region(0, 0))
+        colors = tuple(settings.get(name, default) for name, default in FACE_COLORS)
         scramble = get_scramble(view)
+        key = (scramble, colors, settings.get('analyze_scramble', True))
+        # nearly every edit leaves the first line and the settings alone
+        if drawn_scrambles.get(view.id()) == key:
+            return
+        drawn_scrambles[view.id()] = key
+        view.erase_phantoms('scramble_state')
+        cancel_analysis(view)
+        view.erase_phantoms('scramble_steps')
         if scramble == '':
             return
+        firstLine = view.line(sublime.Region(0, 0))
+        view.add_phantom('scramble_state', firstLine, scramble_html(scramble, colors), sublime.LAYOUT_BLOCK)
+        if not settings.get('analyze_scramble', True):
+            return
+        with finished_lock:
+            lines = finished_analyses.get(scramble)
+        if lines is not None:
+            draw_steps(view, steps_html(lines))
+        else:
+            analysis = ScrambleAnalysis(view, scramble, settings.get('scramble_analysis_time_limit', 5))
+            scramble_analyses[view.id()] = analysis
+            analysis.start()
 
-        cube = FaceletCube(scramble)
-
-        FACELETS = 'urfdlb'
-        rowTemplate = '<div class="row">{}</div>'
-        spanTemplate = '<span class="cell {}">■</span>'
-        rows = ''
-        for row in range(9):
-            spans = ''
-            for col in range(12):
-                if (row < 3 or row >= 6) and (col < 3 or col >= 6):
-                    spans += spanTemplate.format('gap')
-                else:
-                    if row < 3:
-                        idx = cube.state[0][row * 3 + col - 3]
-                        spans += spanTemplate.format(FACELETS[idx])
-                        continue
-                    if row >= 6:
-                        idx = cube.state[3][(row - 6) * 3 + col - 3]
-                        spans += spanTemplate.format(FACELETS[idx])
-                        continue
-                    if col < 3:
-                        idx = cube.state[4][(row - 3) * 3 + col]
-                        spans += spanTemplate.format(FACELETS[idx])
-                        continue
-                    if col < 6:
-                        idx = cube.state[2][(row - 3) * 3 + col - 3]
-                        spans += spanTemplate.format(FACELETS[idx])
-                        continue
-                    if col < 9:
-                        idx = cube.state[1][(row - 3) * 3 + col - 6]
-                        spans += spanTemplate.format(FACELETS[idx])
-                        continue
-                    if col < 12:
-                        idx = cube.state[5][(row - 3) * 3 + col - 9]
-                        spans += spanTemplate.format(FACELETS[idx])
-                        continue
-            rows += rowTemplate.format(spans)
-        view.add_phantom('scramble_state', firstLine, self.HTML_TEMPLATE.format(rows=rows, colorU=colorU, colorR=colorR, colorF=colorF, colorD=colorD, colorL=colorL, colorB=colorB), sublime.LAYOUT_BLOCK)
     def is_enabled(self):
         return is_fewest_moves(self.view)
+
+def save_scramble_steps(view, document):
+    with finished_lock:
+        lines = finished_analyses.get(document.scramble)
+    return None if lines is None else {'scramble': document.scramble, 'lines': lines}
+
+def restore_scramble_steps(view, document, value, exact):
+    if value is not None and value['scramble'] == document.scramble:
+        remember_analysis(value['scramble'], list(value['lines']))
+
+# scramble analysis output, bumped when it changes
+SCRAMBLE_STEPS_VERSION = 1
+
+session_parts.append(('scramble_steps', SCRAMBLE_STEPS_VERSION, save_scramble_steps, restore_scramble_steps))
+
+class DrawScrambleEventListener(sublime_plugin.EventListener):
+    def on_close(self, view):
+        drawn_scrambles.pop(view.id(), None)
+        cancel_analysis(view)
@@ -1,88 +1,127 @@
+from operator import itemgetter
 from .move_transformer import tokenize, parse_move
+
+# URFDLB
+# 012345
+# B face viewed with y2
+# facelet i of face f is stored at f * 9 + i
+
+# 4-cycles of (face, facelet) pairs for a clockwise quarter turn of each face
+QUARTER_TURN_CYCLES = [
+    [
+        ((0, 0), (0, 2), (0, 8), (0, 6)),
+        ((0, 1), (0, 5), (0, 7), (0, 3)),
+        ((1, 0), (2, 0), (4, 0), (5, 0)),
+        ((1, 1), (2, 1), (4, 1), (5, 1)),
+        ((1, 2), (2, 2), (4, 2), (5, 2)),
+    ],
+    [
+        ((1, 0), (1, 2), (1, 8), (1, 6)),
+        ((1, 1), (1, 5), (1, 7), (1, 3)),
+        ((0, 2), (5, 6), (3, 2), (2, 2)),
+        ((0, 5), (5, 3), (3, 5), (2, 5)),
+        ((0, 8), (5, 0), (3, 8), (2, 8)),
+    ],
+    [
+        ((2, 0), (2, 2), (2, 8), (2, 6)),
+        ((2, 1), (2, 5), (2, 7), (2, 3)),
+        ((0, 6), (1, 0), (3, 2), (4, 8)),
+        ((0, 7), (1, 3), (3, 1), (4, 5)),
+        ((0, 8), (1, 6), (3, 0), (4, 2)),
+    ],
+    [
+        ((3, 0), (3, 2), (3, 8), (3, 6)),
+        ((3, 1), (3, 5), (3, 7), (3, 3)),
+        ((1, 6), (5, 6), (4, 6), (2, 6)),
+        ((1, 7), (5, 7), (4, 7), (2, 7)),
+        ((1, 8), (5, 8), (4, 8), (2, 8)),
+    ],
+    [
+        ((4, 0), (4, 2), (4, 8), (4, 6)),
+        ((4, 1), (4, 5), (4, 7), (4, 3)),
+        ((0, 0), (2, 0), (3, 0), (5, 8)),
+        ((0, 3), (2, 3), (3, 3), (5, 5)),
+        ((0, 6), (2, 6), (3, 6), (5, 2)),
+    ],
+    [
+        ((5, 0), (5, 2), (5, 8), (5, 6)),
+        ((5, 1), (5, 5), (5, 7), (5, 3)),
+        ((0, 0), (4, 6), (3, 8), (1, 2)),
+        ((0, 1), (4, 3), (3, 7), (1, 5)),
+        ((0, 2), (4, 0), (3, 6), (1, 8)),
+    ],
+]
+
+SOLVED = bytes(range(54))
+
+# maps a facelet to the face it belongs to, for use with bytes.translate
+COLOR_TABLE = bytes(i // 9 if i < 54 else 0 for i in range(256))
+
+def gather(state, table):
+    """ Returns the state in which facelet i comes from facelet table[i]
+        of the given state. """
+    return bytes(itemgetter(*table)(state))
+
+def quarter_turn(axis):
+    table = bytearray(SOLVED)
+    for a, b, c, d in QUARTER_TURN_CYCLES[axis]:
+        a, b, c, d = [face * 9 + facelet for face, facelet in (a, b, c, d)]
+        table[a], table[b], table[c], table[d] = d, a, b, c
+    return bytes(table)
+
+# MOVE_TABLES[axis * 3 + amount - 1] is the permutation of a face turn
+MOVE_TABLES = []
+for axis in range(6):
+    table = quarter_turn(axis)
+    turn = table
+    for amount in range(3):
+        MOVE_TABLES.append(turn)
+        turn = gather(turn, table)
+MOVE_GETTERS = [itemgetter(*table) for table in MOVE_TABLES]
+
 class FaceletCube:
 
-    def __init__(self, scramble = ''):
-        # URFDLB
-        # 012345
-        # B face viewed with y2
-        self.state = [
-            [0, 0, 0, 0, 0, 0, 0, 0, 0],
-            [1, 1, 1, 1, 1, 1, 1, 1, 1],
-            [2, 2, 2, 2, 2, 2, 2, 2, 2],
-            [3, 3, 3, 3, 3, 3, 3, 3, 3],
-            [4, 4, 4, 4, 4, 4, 4, 4, 4],
-            [5, 5, 5, 5, 5, 5, 5, 5, 5],
-        ]
+    def __init__(self, scramble = '', state = SOLVED):
+        # state[i] is the solved position of the facelet now at position i
+        self.state = state
         self.apply(scramble)
 
     def apply(self, scramble):
         moves = tokenize(scramble)
+        state = self.state
         for move in moves:
             axis, amount = parse_move(move)
-            self.makeMove(axis, amount)
+            state = bytes(MOVE_GETTERS[axis * 3 + amount - 1](state))
+        self.state = state
+        return self
 
     def makeMove(self, axis, amount):
-        for i in range(amount):
-            if axis == 0:
-                self.moveU()
-                continue
-            if axis == 1:
-                self.moveR()
-                continue
-            if axis == 2:
-                self.moveF()
-                continue
-            if axis == 3:
-                self.moveD()
-                continue
-            if axis == 4:
-                self.moveL()
-                continue
-            if axis == 5:
-                self.moveB()
-                continue
-
-    def moveU(self):
-        self.swap(0, 0, 0, 2, 0, 8, 0, 6)
-        self.swap(0, 1, 0, 5, 0, 7, 0, 3)
-        self.swap(1, 0, 2, 0, 4, 0, 5, 0)
-        self.swap(1, 1, 2, 1, 4, 1, 5, 1)
-        self.swap(1, 2, 2, 2, 4, 2, 5, 2)
-    def moveR(self):
-        self.swap(1, 0, 1, 2, 1, 8, 1, 6)
-        self.swap(1, 1, 1, 5, 1, 7, 1, 3)
-        self.swap(0, 2, 5, 6, 3, 2, 2, 2)
-        self.swap(0, 5, 5, 3, 3, 5, 2, 5)
-        self.swap(0, 8, 5, 0, 3, 8, 2, 8)
-    def moveF(self):
-        self.swap(2, 0, 2, 2, 2, 8, 2, 6)
-        self.swap(2, 1, 2, 5, 2, 7, 2, 3)
-        self.swap(0, 6, 1, 0, 3, 2, 4, 8)
-        self.swap(0, 7, 1, 3, 3, 1, 4, 5)
-        self.swap(0, 8, 1, 6, 3, 0, 4, 2)
-    def moveD(self):
-        self.swap(3, 0, 3, 2, 3, 8, 3, 6)
-        self.swap(3, 1, 3, 5, 3, 7, 3, 3)
-        self.swap(1, 6, 5, 6, 4, 6, 2, 6)
-        self.swap(1, 7, 5, 7, 4, 7, 2, 7)
-        self.swap(1, 8, 5, 8, 4, 8, 2, 8)
-    def moveL(self):
-        self.swap(4, 0, 4, 2, 4, 8, 4, 6)
-        self.swap(4, 1, 4, 5, 4, 7, 4, 3)
-        self.swap(0, 0, 2, 0, 3, 0, 5, 8)
-        self.swap(0, 3, 2, 3, 3, 3, 5, 5)
-        self.swap(0, 6, 2, 6, 3, 6, 5, 2)
-    def moveB(self):
-        self.swap(5, 0, 5, 2, 5, 8, 5, 6)
-        self.swap(5, 1, 5, 5, 5, 7, 5, 3)
-        self.swap(0, 0, 4, 6, 3, 8, 1, 2)
-        self.swap(0, 1, 4, 3, 3, 7, 1, 5)
-        self.swap(0, 2, 4, 0, 3, 6, 1, 8)
-
-    def swap(self, a, b, c, d, e, f, g, h):
-        tmp = self.state[a][b]
-        self.state[a][b] = self.state[g][h]
-        self.state[g][h] = self.state[e][f]
-        self.state[e][f] = self.state[c][d]
-        self.state[c][d] = tmp
+        amount %= 4
+        if amount:
+            self.state = bytes(MOVE_GETTERS[axis * 3 + amount - 1](self.state))
+
+    def copy(self):
+        return FaceletCube(state=self.state)
+
+    def compose(self, other):
+        """ Returns the cube reached by applying other's moves after ours. """
+        return FaceletCube(state=gather(self.state, other.state))
+
+    def inverse(self):
+        state = bytearray(54)
+        for position, facelet in enumerate(self.state):
+            state[facelet] = position
+        return FaceletCube(state=bytes(state))
+
+    def colors(self):
+        """ Returns the face color (0-5, URFDLB) of all 54 facelets. """
+        return self.state.translate(COLOR_TABLE)
+
+    def __eq__(self, other):
+        return isinstance(other, FaceletCube) and self.state == other.state
+
+    def __ne__(self, other):
+        return not self == other
 
+    def __hash__(self):
+        return hash(self.state)
@@ -1,14 +1,33 @@
 import sublime
 import sublime_plugin
+import os
 import re
+import shutil
 import subprocess as sp
+import sys
 from platform import system
-from json import loads
-from threading import Timer, Thread
-from .move_transformer import normalize
+from threading import Thread, Timer, Condition, Lock
+from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from collections import OrderedDict
+from functools import lru_cache
+import traceback
+from .facelet_cube import FaceletCube, SOLVED
+from .cycle_analyzer import analyze, analyze_cube, total_cycles, describe
+from .result_cache import ResultCache
+from .session_cache import SessionCache, content_digest
+from .document import Document
+from .instrumentation import stats, timed
+from .symmetry import SymmetryClasses
+from .insertion_engine import get_algorithm_table, find_insertions, format_result
 
 phantom_name_line_end = 'line_move_count'
 phantom_name_block = 'total_move_count'
+phantom_name_cycles = 'cycle_count'
+
+# skeleton analyses kept per view, the least recently shown are dropped
+CACHED_ANALYSES = 4096
 
 startupinfo = None
 
@@ -17,70 +36,669 @@ if 'windows' in system().lower():
     startupinfo.dwFlags |= sp.STARTF_USESHOWWINDOW
     startupinfo.wShowWindow = sp.SW_HIDE
 
+# result of the scope check of each view, forgotten when the view's
+# settings change, its syntax being one of them
+fewest_moves_views = {}
+# views whose settings are watched, once each
+watched_views = set()
+
 def is_fewest_moves(view):
-    return 'source.fm' in view.scope_name(0)
-
-def remove_comments(text):
-    comment_pattern = re.compile(r'(?://|#).*(?=\n|$)')
-    text = re.sub(comment_pattern, '', text)
-    return text
-
-def debounce(wait):
-    """ Decorator that will postpone a functions
-        execution until after wait seconds
-        have elapsed since the last time it was invoked. """
-    def decorator(fn):
-        def debounced(*args, **kwargs):
-            def call_it():
-                fn(*args, **kwargs)
-            try:
-                debounced.t.cancel()
-            except(AttributeError):
-                pass
-            debounced.t = Timer(wait, call_it)
-            debounced.t.start()
-        return debounced
-    return decorator
+    result = fewest_moves_views.get(view.id())
+    if result is None:
+        result = fewest_moves_views[view.id()] = 'source.fm' in view.scope_name(0)
+        if view.id() not in watched_views:
+            watched_views.add(view.id())
+            view.settings().add_on_change('fewest_moves_scope', lambda: fewest_moves_views.pop(view.id(), None))
+    return result
+
+def forget_scope(view):
+    fewest_moves_views.pop(view.id(), None)
+    if view.id() in watched_views:
+        watched_views.discard(view.id())
+        view.settings().clear_on_change('fewest_moves_scope')
+
+documents = {}
+document_lock = Lock()
+
+def get_document(view):
+    """ Returns the parsed document of a view, the text is only read
+        again once the view changed. A changed text gives a new document
+        and returned ones are never changed, so threads can keep reading
+        theirs without the lock. """
+    with document_lock:
+        document = documents.get(view.id())
+        changeCount = view.change_count()
+        if document is None or document.change_count != changeCount:
+            with timed('parse'):
+                document = (document or Document()).updated(view.substr(sublime.Region(0, view.size())))
+            document.change_count = changeCount
+            documents[view.id()] = document
+        return document
+
+class MoveCountCache:
+    """ Per-view phantoms and skeleton analyses, phantoms are only
+        updated when their contents change. The lock guards the scramble,
+        analyses and notes, which sessions copy from the UI thread. """
+
+    def __init__(self, view):
+        self.line_phantoms = sublime.PhantomSet(view, phantom_name_line_end)
+        self.block_phantoms = sublime.PhantomSet(view, phantom_name_block)
+        self.cycle_phantoms = sublime.PhantomSet(view, phantom_name_cycles)
+        self.line_keys = []
+        self.block_keys = []
+        self.cycle_keys = []
+        self.window = None
+        self.scramble = None
+        self.scramble_cube = None
+        self.analyses = OrderedDict()
+        self.states = {}
+        self.notes = {}
+        self.notes_revision = 0
+        # change count of the text the notes are for
+        self.notes_change_count = None
+        self.lock = Lock()
+
+    def cycles(self, document, block):
+        """ Returns the phantom text describing what is left to solve after
+            the skeleton of a block. """
+        self.check_scramble(document)
+        skeleton = block.skeleton
+        with self.lock:
+            text = self.analyses.get(skeleton)
+            if text is not None:
+                self.analyses.move_to_end(skeleton)
+        if text is None:
+            result = analyze_cube(self.scramble_cube.copy().apply(skeleton))
+            text = describe_skeleton(skeleton, result)
+            with self.lock:
+                self.add_analysis(skeleton, text)
+        return text
+
+    def add_analysis(self, skeleton, text):
+        """ Called with the lock held. """
+        self.analyses[skeleton] = text
+        if len(self.analyses) > CACHED_ANALYSES:
+            self.analyses.popitem(False)
+
+    def check_scramble(self, document):
+        scramble = document.scramble
+        if scramble != self.scramble:
+            with self.lock:
+                self.scramble = scramble
+                self.scramble_cube = FaceletCube(scramble)
+                self.analyses = OrderedDict()
+            self.states = {}
+
+    def find_duplicates(self, document):
+        """ Sets the notes of the blocks leaving the same cube state as an
+            earlier block, or a mirror or rotation of it, by first line.
+            Returns whether they changed. """
+        self.check_scramble(document)
+        classes = SymmetryClasses()
+        notes = {}
+        states = {}
+        for block in document.blocks():
+            skeleton = block.skeleton
+            state = self.states.get(skeleton)
+            if state is None:
+                state = self.scramble_cube.copy().apply(skeleton).state
+            states[skeleton] = state
+            if state == SOLVED:
+                continue
+            first, original = classes.add(state, (block.first, state))
+            if first != block.first:
+                notes[block.first] = duplicate_note(state, original, first + 1)
+        # only keep the states of skeletons still in the file
+        self.states = states
+        with self.lock:
+            self.notes_change_count = document.change_count
+            if notes == self.notes:
+                return False
+            self.notes = notes
+            self.notes_revision += 1
+        return True
+
+move_count_caches = {}
+
+def get_move_count_cache(view):
+    cache = move_count_caches.get(view.id())
+    if cache is None:
+        cache = move_count_caches[view.id()] = MoveCountCache(view)
+    return cache
+
+def phantom_window(view, cache):
+    """ Returns the first and last rows getting phantoms, the visible rows
+        plus phantom_margin rows around them. The current window is kept
+        while it covers half of that margin. """
+    margin = view.settings().get('phantom_margin', 100)
+    region = view.visible_region()
+    first = view.rowcol(region.begin())[0]
+    last = view.rowcol(region.end())[0]
+    window = cache.window
+    if window is not None and window[0] <= max(0, first - margin // 2) and last + margin // 2 <= window[1]:
+        return window
+    return (max(0, first - margin), last + margin)
+
+def duplicate_note(state, original, line):
+    if state == original:
+        return 'same state as line {}'.format(line)
+    return 'symmetric to line {}'.format(line)
+
+def describe_skeleton(skeleton, result):
+    length = len(skeleton.split())
+    return ('{} move, {}' if length == 1 else '{} moves, {}').format(length, describe(result))
+
+class Scheduler(Thread):
+    """ Runs delayed per-view tasks on one long-lived worker thread.
+        Pending work is coalesced by view and task name, and a task is
+        skipped when its key hasn't changed since it last ran. """
+
+    def __init__(self, wait):
+        Thread.__init__(self)
+        self.daemon = True
+        self.wait = wait
+        self.condition = Condition()
+        self.pending = {}
+        self.last_keys = {}
+        self.stopped = False
+
+    def schedule(self, view, name, task, key, wait=None):
+        if wait is None:
+            wait = self.wait
+        with self.condition:
+            # started by the first Fewest Moves view
+            if self.ident is None and not self.stopped:
+                self.start()
+            self.pending[(view.id(), name)] = (time() + wait, time(), view, task, key)
+            self.condition.notify()
+
+    def forget(self, view):
+        with self.condition:
+            for job in [job for job in self.pending if job[0] == view.id()]:
+                del self.pending[job]
+            for job in [job for job in self.last_keys if job[0] == view.id()]:
+                del self.last_keys[job]
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                due = []
+                while not self.stopped:
+                    now = time()
+                    due = [job for job, pending in self.pending.items() if pending[0] <= now]
+                    if due:
+                        break
+                    timeout = None
+                    if self.pending:
+                        timeout = min(pending[0] for pending in self.pending.values()) - now
+                    self.condition.wait(timeout)
+                if self.stopped:
+                    return
+                jobs = [(job, self.pending.pop(job)) for job in due]
+            for job, (_, scheduled, view, task, key) in jobs:
+                try:
+                    current = key(view)
+                    if job in self.last_keys and self.last_keys[job] == current:
+                        continue
+                    if stats.enabled:
+                        # at least the debounce delay, never worth a warning
+                        stats.record('debounce', time() - scheduled, False)
+                    task(view)
+                    self.last_keys[job] = current
+                except Exception:
+                    traceback.print_exc()
+
+scheduler = Scheduler(1)
+
+viewport_polling = False
+
+def start_viewport_polling():
+    global viewport_polling
+    if not viewport_polling:
+        viewport_polling = True
+        sublime.set_timeout_async(poll_viewport, 250)
+
+def plugin_unloaded():
+    global viewport_polling
+    viewport_polling = False
+    scheduler.stop()
+
+def poll_viewport():
+    """ Scrolling has no event, so the active view is checked for
+        phantoms scrolled into sight a few times a second. """
+    if not viewport_polling:
+        return
+    window = sublime.active_window()
+    view = window.active_view() if window is not None else None
+    if view is not None:
+        check_viewport(view)
+    sublime.set_timeout_async(poll_viewport, 250)
+
+def check_viewport(view):
+    cache = move_count_caches.get(view.id())
+    if cache is None or cache.window is None or not is_fewest_moves(view):
+        return
+    if phantom_window(view, cache) != cache.window:
+        scheduler.schedule(view, 'count_moves', count_moves, phantom_key, 0.05)
 
 def get_scramble(view):
-    firstLine = view.line(sublime.Region(0, 0))
-    scramble = view.substr(firstLine)
-    scramble = remove_comments(scramble)
-    scramble = normalize(scramble)
-    return scramble
-
-def get_skeleton(view):
-    sel = view.sel()
-    selection = sel[0].begin()
-    expanded = view.expand_by_class(selection, sublime.CLASS_EMPTY_LINE)
-    skeleton = view.substr(expanded)
-    skeleton = remove_comments(skeleton)
-    skeleton = normalize(skeleton)
-    return skeleton
+    return get_document(view).scramble
+
+def get_skeleton(view, row=None, document=None):
+    """ Returns the skeleton of the block at row, the cursor's one by
+        default, in document or the view's current one. """
+    if row is None:
+        row = view.rowcol(view.sel()[0].begin())[0]
+    if document is None:
+        document = get_document(view)
+    block = document.block_at(row)
+    return block.skeleton if block is not None else ''
+
+def show_error(message):
+    """ Shows an error message from any thread. """
+    sublime.set_timeout(lambda: sublime.error_message(message), 0)
+
+best_solution_pattern = re.compile(r'(?:fewest|total)\s+moves\s*:\s*(\d+)', re.IGNORECASE)
 
 class CallInsertionFinder(Thread):
-    def __init__(self, command, input_str, timeout, callback):
+    """ Runs insertionfinder and passes its output to on_output in batches
+        while it is still running. """
+
+    batch_size = 64 * 1024
+    batch_interval = 0.2
+    stderr_limit = 64 * 1024
+
+    def __init__(self, command, input_str, timeout, on_output, callback):
         self.command = command
         self.input_str = input_str
         self.timeout = timeout
+        self.on_output = on_output
         self.callback = callback
+        self.process = None
+        self.cancelled = False
+        self.timed_out = False
+        self.stderr = b''
         Thread.__init__(self)
     def run(self):
-        result = None
         error = None
         try:
-            p = sp.Popen(self.command, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, startupinfo=startupinfo)
-            result, error = p.communicate(self.input_str.encode(), self.timeout)
-            result = result.decode()
-            error = error.decode()
+            with timed('insertion_spawn'):
+                p = self.process = sp.Popen(self.command, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, startupinfo=startupinfo)
+            if self.cancelled:
+                p.kill()
+            stderrReader = Thread(target=self.read_stderr)
+            stderrReader.start()
+            timer = Timer(self.timeout, self.expire)
+            timer.start()
+            try:
+                try:
+                    p.stdin.write(self.input_str.encode())
+                    p.stdin.close()
+                except OSError:
+                    pass
+                self.read_stdout()
+                p.wait()
+            finally:
+                timer.cancel()
+            stderrReader.join()
+            error = self.stderr.decode(errors='replace')
+            if self.timed_out:
+                error = 'Timeout of {} seconds has expired.'.format(self.timeout)
         except OSError as e:
             error = e.strerror
-        except sp.TimeoutExpired as e:
-            p.kill()
-            error = 'Timeout of {} seconds has expired.'.format(e.timeout)
         except:
             error = 'Unknown error'
-        self.callback(result, error)
+        if self.cancelled:
+            error = None
+        self.callback(error)
+    def read_stdout(self):
+        batch = []
+        size = 0
+        flushed = 0
+        for line in iter(self.process.stdout.readline, b''):
+            batch.append(line)
+            size += len(line)
+            if size >= self.batch_size or time() - flushed >= self.batch_interval or best_solution_pattern.search(line.decode(errors='replace')):
+                self.on_output(b''.join(batch).decode(errors='replace'))
+                batch = []
+                size = 0
+                flushed = time()
+        if batch:
+            self.on_output(b''.join(batch).decode(errors='replace'))
+    def read_stderr(self):
+        for chunk in iter(lambda: self.process.stderr.read(4096), b''):
+            self.stderr = (self.stderr + chunk)[-self.stderr_limit:]
+    def expire(self):
+        self.timed_out = True
+        self.kill()
+    def cancel(self):
+        self.cancelled = True
+        self.kill()
+    def kill(self):
+        if self.process is not None:
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+
+class CallInsertionEngine(Thread):
+    """ Runs the built-in insertion search, same interface as
+        CallInsertionFinder. callback also gets whether the time limit
+        cut the search short. """
+
+    def __init__(self, scramble, skeleton, time_limit, processes, on_output, callback):
+        self.scramble = scramble
+        self.skeleton = skeleton
+        self.time_limit = time_limit
+        self.processes = processes
+        self.on_output = on_output
+        self.callback = callback
+        self.cancelled = False
+        Thread.__init__(self)
+    def run(self):
+        error = None
+        expired = False
+        try:
+            table = get_algorithm_table()
+            solutions, expired = find_insertions(self.scramble, self.skeleton, table, self.time_limit, self.processes, lambda: self.cancelled)
+            if not self.cancelled:
+                self.on_output(format_result(self.scramble, self.skeleton, solutions, expired, self.time_limit))
+        except:
+            traceback.print_exc()
+            error = 'Unknown error'
+        if self.cancelled:
+            error = None
+        self.callback(error, expired)
+    def cancel(self):
+        self.cancelled = True
+
+class InsertionResultView:
+    """ Appends the output of an insertion search to a scratch view as it
+        arrives, naming the view after the best solution seen so far.
+        Output arriving faster than the view takes it is merged, with one
+        call to show queued at most. """
+
+    def __init__(self, window):
+        self.window = window
+        self.view = None
+        self.best = None
+        self.lock = Lock()
+        self.pending = []
+        self.queued = False
+
+    def append(self, text):
+        with self.lock:
+            for match in best_solution_pattern.finditer(text):
+                moves = int(match.group(1))
+                if self.best is None or moves < self.best:
+                    self.best = moves
+            self.pending.append(text)
+            if self.queued:
+                return
+            self.queued = True
+        sublime.set_timeout(self.flush, 0)
+
+    def flush(self):
+        with self.lock:
+            text = ''.join(self.pending)
+            self.pending = []
+            self.queued = False
+            best = self.best
+        self.show(text, best)
+
+    def finish(self, error, cancelled):
+        if not cancelled:
+            sublime.set_timeout(lambda: self.finished(error), 0)
+
+    def show(self, text, best):
+        with timed('insertion_render'):
+            if self.view is None:
+                self.view = (self.window or sublime.active_window()).new_file()
+                self.view.set_scratch(True)
+            self.view.run_command('show_solution', {"text": text})
+            if best is not None:
+                self.view.set_name('Insertions (best: {} moves)'.format(best))
+
+    def finished(self, error):
+        if error:
+            sublime.error_message(error)
+            return
+        if self.view is None:
+            self.show('', None)
+
+class CachedOutput:
+    """ Copies the output of a search into the result cache on its way to
+        the result view, the entry is kept only if the search succeeds
+        within its time limit. """
+
+    def __init__(self, cache, key, resultView):
+        self.cache = cache
+        self.key = key
+        self.result_view = resultView
+        self.writer = None
+
+    def append(self, text):
+        if self.writer is None:
+            self.writer = self.cache.writer(self.key) or False
+        if self.writer:
+            self.writer.write(text)
+        self.result_view.append(text)
+
+    def finish(self, error, cancelled, expired=False):
+        if self.writer:
+            # a longer search may still improve on a result cut short
+            if error or cancelled or expired:
+                self.writer.discard()
+            else:
+                self.writer.commit()
+        self.result_view.finish(error, cancelled)
+
+insertion_result_cache = None
+
+def get_result_cache(settings):
+    global insertion_result_cache
+    if insertion_result_cache is None:
+        directory = os.path.join(sublime.cache_path(), 'Fewest Moves', 'insertions')
+        insertion_result_cache = ResultCache(directory, 0)
+    insertion_result_cache.max_size = settings.get('insertion_cache_size', 32) * 1024 * 1024
+    return insertion_result_cache
+
+view_session_cache = None
+
+def get_session_cache(settings):
+    global view_session_cache
+    if view_session_cache is None:
+        directory = os.path.join(sublime.cache_path(), 'Fewest Moves', 'sessions')
+        view_session_cache = SessionCache(directory, 0)
+    view_session_cache.max_size = settings.get('session_cache_size', 16) * 1024 * 1024
+    return view_session_cache
+
+# parts of a session as (name, version, save, restore): save(view,
+# document) returns what to keep of a view, restore(view, document, value,
+# exact) puts it back into a reopened view, exact telling whether the text
+# is the one it was saved with. Values are stored with their version and
+# only restored by the same version, which changes whenever the code
+# working them out gives other results. Other modules of the plugin add
+# theirs.
+session_parts = []
+
+def restore_session(view):
+    file_name = view.file_name()
+    if file_name is None:
+        return
+    session = get_session_cache(view.settings()).load(file_name)
+    if session is None:
+        return
+    with timed('restore_session'):
+        document = get_document(view)
+        exact = session.get('digest') == content_digest(document.text())
+        for name, version, save, restore in session_parts:
+            try:
+                savedVersion, value = session[name]
+                if savedVersion != version:
+                    continue
+                restore(view, document, value, exact)
+            except (KeyError, TypeError, ValueError, AttributeError):
+                # left for the refresh to work out again
+                continue
+
+def session_snapshot(view):
+    """ Returns the file name and session of a view, None for views
+        without a file or a parsed text. """
+    file_name = view.file_name()
+    if file_name is None:
+        return None
+    with document_lock:
+        document = documents.get(view.id())
+        if document is None:
+            return None
+        session = {name: (version, save(view, document)) for name, version, save, restore in session_parts}
+        session['digest'] = content_digest(document.text())
+    return file_name, session
+
+def save_session(view):
+    snapshot = session_snapshot(view)
+    if snapshot is not None:
+        get_session_cache(view.settings()).save(*snapshot)
+
+def save_move_counts(view, document):
+    cache = move_count_caches.get(view.id())
+    value = {'scramble': document.scramble, 'skeletons': document.copy_skeletons()}
+    if cache is not None:
+        with cache.lock:
+            if cache.scramble == document.scramble:
+                value['analyses'] = dict(cache.analyses)
+                if cache.notes_change_count == document.change_count:
+                    value['notes'] = dict(cache.notes)
+    return value
+
+def restore_move_counts(view, document, value, exact):
+    # skeletons and analyses only depend on the moves of their block, only
+    # notes need the whole text to be the same
+    document.add_skeletons(value['skeletons'])
+    if value['scramble'] != document.scramble:
+        return
+    cache = get_move_count_cache(view)
+    cache.check_scramble(document)
+    with cache.lock:
+        for skeleton, text in value.get('analyses', {}).items():
+            cache.add_analysis(skeleton, text)
+        if exact and 'notes' in value:
+            cache.notes = value['notes']
+            cache.notes_revision += 1
+            cache.notes_change_count = document.change_count
+
+# normalize, describe_skeleton and duplicate_note output, bumped when any
+# of them changes
+MOVE_COUNTS_VERSION = 1
+
+session_parts.append(('move_counts', MOVE_COUNTS_VERSION, save_move_counts, restore_move_counts))
+
+class InsertionJob:
+    def __init__(self, id, view, runner, concurrency, on_output, callback):
+        self.id = id
+        self.view = view
+        self.runner = runner
+        self.concurrency = concurrency
+        self.on_output = on_output
+        self.callback = callback
+        self.thread = None
+        self.started = None
+        self.status_key = 'insertion_finder_{}'.format(id)
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+class InsertionJobManager:
+    """ Queues insertion searches from all views and runs as many of them
+        at once as the views' max_concurrent_searches allow. """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.queue = []
+        self.running = []
+        self.next_id = 0
+
+    def submit(self, view, runner, concurrency, on_output, callback):
+        """ Queues a search, runner(on_output, callback) creating the thread
+            that runs it. """
+        with self.lock:
+            self.next_id += 1
+            job = InsertionJob(self.next_id, view, runner, concurrency, on_output, callback)
+            self.queue.append(job)
+        self.start_next()
+        self.show_status(job, 0, 1)
+        return job
+
+    def start_next(self):
+        started = []
+        with self.lock:
+            while self.queue and len(self.running) < self.queue[0].concurrency:
+                job = self.queue.pop(0)
+                job.thread = job.runner(job.on_output, lambda error, expired=False, job=job: self.finish(job, error, expired))
+                job.started = time()
+                self.running.append(job)
+                started.append(job)
+        for job in started:
+            job.thread.start()
+
+    def finish(self, job, error, expired):
+        if stats.active:
+            stats.record('insertion_search', time() - job.started)
+        with self.lock:
+            if job in self.running:
+                self.running.remove(job)
+        self.start_next()
+        job.callback(error, job.thread.cancelled, expired)
+
+    def cancel(self, view):
+        with self.lock:
+            queued = [job for job in self.queue if job.view.id() == view.id()]
+            running = [job for job in self.running if job.view.id() == view.id()]
+            for job in queued:
+                self.queue.remove(job)
+        for job in running:
+            job.thread.cancel()
+        return len(queued) + len(running)
+
+    def jobs(self, view):
+        with self.lock:
+            return [job for job in self.queue + self.running if job.view.id() == view.id()]
+
+    def is_active(self, job):
+        with self.lock:
+            return job in self.queue or job in self.running
+
+    def show_status(self, job, i, dir):
+        if not self.is_active(job):
+            job.view.erase_status(job.status_key)
+            return
+        if job.running:
+            before = i % 8
+            after = 7 - before
+            dir = -1 if not after else dir
+            dir = 1 if not before else dir
+            i += dir
+            job.view.set_status(job.status_key, 'Finding insertions #{} [{}={}]'.format(job.id, ' ' * before, ' ' * after))
+        else:
+            job.view.set_status(job.status_key, 'Insertion search #{} queued'.format(job.id))
+        sublime.set_timeout_async(lambda: self.show_status(job, i, dir), 100)
+
+job_manager = InsertionJobManager()
+
+def search_threads(max_threads, concurrency):
+    """ Splits the max_threads budget between concurrent searches, returns
+        the value for insertionfinder's -j option, '' for auto. """
+    if concurrency <= 1:
+        return str(max_threads) if max_threads != 0 else ''
+    budget = max_threads if max_threads != 0 else (cpu_count() or 1)
+    return str(max(1, budget // concurrency))
 
 class CountMovesCommand(sublime_plugin.TextCommand):
 
@@ -107,129 +725,476 @@ class CountMovesCommand(sublime_plugin.TextCommand):
     """
 
     def run(self, edit):
+        with timed('count_moves'):
+            self.update_phantoms()
+
+    def update_phantoms(self):
         view = self.view
-        view.erase_phantoms(phantom_name_line_end)
-        view.erase_phantoms(phantom_name_block)
-        pattern = re.compile("([URFDLB]w?['2]?)")
-        region = sublime.Region(0, view.size())
-        lines = view.lines(region)
-        lineNumber = 0
-        total = 0
-        previousLine = None
-        for line in lines:
-            lineNumber += 1
-            text = view.substr(line)
-            text = remove_comments(text)
-            count = len(re.findall(pattern, text))
-            if count > 0:
+        cache = get_move_count_cache(view)
+        document = get_document(view)
+        lines = document.lines
+        offsets = document.offsets
+        first, last = cache.window = phantom_window(view, cache)
+
+        lineKeys = [(offsets[i] + len(lines[i].text), lines[i].count) for i in range(first, min(last + 1, len(lines))) if lines[i].count > 0]
+        if lineKeys != cache.line_keys:
+            phantoms = []
+            for end, count in lineKeys:
                 moves = ('({} move)' if count == 1 else '({} moves)').format(count)
-                view.add_phantom(phantom_name_line_end, sublime.Region(line.end(), line.end()), self.HTML_TEMPLATE.format(foreground='#7f7c6a', font_style='italic', padding=20, text=moves), sublime.LAYOUT_INLINE)
-            total += count
-            if text == '':
-                if lineNumber > 2 and total > 0:
-                    moves = ('(total: {} move)' if total == 1 else '(total: {} moves)').format(total)
-                    view.add_phantom(phantom_name_block, previousLine, self.HTML_TEMPLATE.format(foreground='#7f7c6a', font_style='italic', padding=0, text=moves), sublime.LAYOUT_BLOCK)
-                total = 0
-            previousLine = line
-        if lineNumber > 2 and total > 0:
-            moves = ('(total: {} move)' if total == 1 else '(total: {} moves)').format(total)
-            view.add_phantom(phantom_name_block, previousLine, self.HTML_TEMPLATE.format(foreground='#7f7c6a', font_style='italic', padding=0, text=moves), sublime.LAYOUT_BLOCK)
-        total = 0
+                phantoms.append(sublime.Phantom(sublime.Region(end, end), phantom_html(moves, 20), sublime.LAYOUT_INLINE))
+            with timed('phantoms'):
+                cache.line_phantoms.update(phantoms)
+            cache.line_keys = lineKeys
+
+        # a block crossing the window edge still counts all of its lines
+        blocks = [block for block in document.blocks() if block.last >= first and block.first <= last]
+        blockKeys = [(offsets[block.last], offsets[block.last] + len(lines[block.last].text), block.total) for block in blocks]
+        if blockKeys != cache.block_keys:
+            phantoms = []
+            for begin, end, total in blockKeys:
+                moves = ('(total: {} move)' if total == 1 else '(total: {} moves)').format(total)
+                phantoms.append(sublime.Phantom(sublime.Region(begin, end), phantom_html(moves, 0), sublime.LAYOUT_BLOCK))
+            with timed('phantoms'):
+                cache.block_phantoms.update(phantoms)
+            cache.block_keys = blockKeys
+
+        cycleKeys = []
+        if view.settings().get('show_cycles', True):
+            notes = cache.notes if view.settings().get('flag_duplicates', True) else {}
+            for block in blocks:
+                text = cache.cycles(document, block)
+                if block.first in notes:
+                    text += ', ' + notes[block.first]
+                cycleKeys.append((offsets[block.last], offsets[block.last] + len(lines[block.last].text), text))
+        if cycleKeys != cache.cycle_keys:
+            phantoms = []
+            for begin, end, text in cycleKeys:
+                phantoms.append(sublime.Phantom(sublime.Region(begin, end), phantom_html('({})'.format(text), 0), sublime.LAYOUT_BLOCK))
+            with timed('phantoms'):
+                cache.cycle_phantoms.update(phantoms)
+            cache.cycle_keys = cycleKeys
+
     def is_enabled(self):
         return is_fewest_moves(self.view)
 
+# a few windows' worth of phantoms, from any view
+@lru_cache(maxsize=1024)
+def phantom_html(text, padding):
+    return CountMovesCommand.HTML_TEMPLATE.format(foreground='#7f7c6a', font_style='italic', padding=padding, text=text)
+
 class ShowSolutionCommand(sublime_plugin.TextCommand):
     def run(self, edit, text):
-        self.view.insert(edit, 0, text)
+        self.view.set_read_only(False)
+        self.view.insert(edit, self.view.size(), text)
         self.view.set_read_only(True)
 
-class FindInsertionCommand(sublime_plugin.TextCommand):
-    running = False
-    insertion_finder = 'insertionfinder'
+def insertion_command(settings, threads):
+    """ Returns the insertionfinder command line and the algs directory
+        (None for the default algs). """
+    command = [settings.get('insertion_finder', 'insertionfinder'), '-s', '--all-algs']
+    algs_dir = settings.get('insertion_finder_algs_dir', False)
+    if algs_dir is not False:
+        command += ['--algs-dir', algs_dir]
+    else:
+        algs_dir = None
+    command += ['-j' + threads]
+    return command, algs_dir
 
-    @property
-    def check_cycles(self):
-        return [self.insertion_finder] + ['-v', '--json']
+def can_fork():
+    """ Whether multiprocessing starts workers by forking. Python 3.3,
+        which Sublime Text runs plugins on, has no get_start_method and
+        forks everywhere but on Windows. """
+    try:
+        from multiprocessing import get_start_method
+    except ImportError:
+        return sys.platform != 'win32'
+    return get_start_method() == 'fork'
 
-    @property
-    def find_insertion(self):
-        return [self.insertion_finder] + ['-s', '--all-algs']
+def insertion_engine(settings, threads):
+    """ Returns runner(scramble, skeleton, on_output, callback) creating
+        the thread of a search, the flags its results are cached under and
+        the algs directory.
 
+        The built-in engine is used when insertion_engine says so, or in
+        auto mode when insertionfinder can't be found. """
+    engine = settings.get('insertion_engine', 'auto')
+    finder = settings.get('insertion_finder', 'insertionfinder')
+    if engine == 'builtin' or (engine == 'auto' and shutil.which(finder) is None):
+        timeLimit = settings.get('builtin_engine_time_limit', 10)
+        processes = int(threads) if threads else 0
+        # the plugin host can't spawn fresh interpreters, only fork
+        if not can_fork():
+            processes = 1
+        def runner(scramble, skeleton, on_output, callback):
+            return CallInsertionEngine(scramble, skeleton, timeLimit, processes, on_output, callback)
+        # the number of processes changes which solutions are found first
+        return runner, ['builtin', timeLimit, processes], None
+    command, algs_dir = insertion_command(settings, threads)
+    timeout = settings.get('insertion_finder_timeout', 300)
+    def runner(scramble, skeleton, on_output, callback):
+        return CallInsertionFinder(command, '\n'.join([scramble, skeleton]), timeout, on_output, callback)
+    # the thread count doesn't change the output
+    return runner, command[:-1], algs_dir
+
+class FindInsertionCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         view = self.view
-        settings = view.settings()
-        scramble = get_scramble(view)
-        skeleton = get_skeleton(view)
-        input_str = '\n'.join([scramble, skeleton])
-        self.insertion_finder = settings.get('insertion_finder', self.insertion_finder)
+        row = view.rowcol(view.sel()[0].begin())[0]
+        # parsing, the result cache and finding the engine can all touch
+        # the disk, only the cursor is read on the UI thread
+        Thread(target=self.start, args=(row, view.window())).start()
+
+    def start(self, row, window):
         try:
-            p = sp.Popen(self.check_cycles, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, startupinfo=startupinfo)
-        except OSError as e:
-            sublime.error_message(e.strerror)
-            return
-        except:
-            sublime.error_message('Some error occurred')
-            return
-        result, error = p.communicate(input_str.encode())
-        if error:
-            sublime.error_message(error.decode())
-            return
-        result = result.decode()
-        result = loads(result)
-        total_cycles = result['corner_cycles'] + result['edge_cycles'] + result['center_cycles']
-        if result['parity']:
-            total_cycles += 1
+            self.search(row, window)
+        except Exception:
+            traceback.print_exc()
+            show_error('Unknown error')
+
+    def search(self, row, window):
+        view = self.view
+        settings = view.settings()
+        with timed('insertion_precheck'):
+            # scramble and skeleton from the same text
+            document = get_document(view)
+            scramble = document.scramble
+            skeleton = get_skeleton(view, row, document)
+            cycles = total_cycles(analyze(scramble, skeleton))
         max_cycles = settings.get('max_cycles', 4)
-        if max_cycles != 0 and total_cycles > max_cycles:
-            sublime.error_message('Too many cycles: {}'.format(total_cycles))
+        if max_cycles != 0 and cycles > max_cycles:
+            show_error('Too many cycles: {}'.format(cycles))
             return
-        command = self.find_insertion[:]
-        algs_dir = settings.get('insertion_finder_algs_dir', False)
-        if algs_dir is not False:
-            command += ['--algs-dir', algs_dir]
         max_threads = settings.get('max_threads', 2)
-        command += ['-j' + (str(max_threads) if max_threads != 0 else '')]
-        timeout = settings.get('insertion_finder_timeout', 300)
-        t = CallInsertionFinder(command, input_str, timeout, self.handle_result)
-        self.running = True
-        self.show_running(0, 1)
-        t.start()
-
-    def show_running(self, i, dir):
-        before = i % 8
-        after = 7 - before
-        dir = -1 if not after else dir
-        dir = 1 if not before else dir
-        i += dir
-        status_key = 'insertion_finder'
-        self.view.set_status(status_key, 'Finding insertions [{}={}]'.format(' ' * before, ' ' * after))
-        if self.running:
-            sublime.set_timeout_async(lambda: self.show_running(i, dir), 100)
-        else:
-            self.view.erase_status(status_key)
+        concurrency = max(1, settings.get('max_concurrent_searches', 1))
+        runner, flags, algs_dir = insertion_engine(settings, search_threads(max_threads, concurrency))
+        resultView = InsertionResultView(window)
+        cache = get_result_cache(settings)
+        key = cache.key(scramble, skeleton, algs_dir, flags)
+        cached = cache.get(key)
+        if cached is not None:
+            resultView.append(cached)
+            resultView.finish(None, False)
+            return
+        output = CachedOutput(cache, key, resultView)
+        job_manager.submit(view, lambda on_output, callback: runner(scramble, skeleton, on_output, callback), concurrency, output.append, output.finish)
 
-    def handle_result(self, result, error):
-        self.running = False
-        if error:
-            sublime.error_message(error)
+    def is_enabled(self):
+        return is_fewest_moves(self.view)
+
+class TruncatedOutput:
+    """ The first limit characters of a search output, and the best
+        solution found in all of it. """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.chunks = []
+        self.size = 0
+        self.truncated = False
+        self.best = None
+
+    def append(self, text):
+        for match in best_solution_pattern.finditer(text):
+            moves = int(match.group(1))
+            if self.best is None or moves < self.best:
+                self.best = moves
+        kept = text[:max(0, self.limit - self.size)]
+        if kept:
+            self.chunks.append(kept)
+            self.size += len(kept)
+        if len(kept) < len(text):
+            self.truncated = True
+
+    def text(self):
+        text = ''.join(self.chunks)
+        return text + '\n[output truncated]\n' if self.truncated else text
+
+class BatchInsertionSearch(Thread):
+    """ Searches insertions for a list of skeletons with a bounded pool of
+        searches and shows a summary sorted by the final move count. """
+
+    output_limit = 64 * 1024
+
+    def __init__(self, view, scramble, entries, runner, flags, algs_dir, size, cache):
+        self.view = view
+        self.scramble = scramble
+        self.entries = entries
+        self.runner = runner
+        self.flags = flags
+        self.algs_dir = algs_dir
+        self.size = size
+        self.cache = cache
+        self.lock = Lock()
+        self.finders = []
+        self.cancelled = False
+        self.done = 0
+        self.status_key = 'insertion_finder_batch'
+        Thread.__init__(self)
+
+    def run(self):
+        eligible = [entry for entry in self.entries if entry['eligible']]
+        self.show_status()
+        with ThreadPoolExecutor(self.size) as pool:
+            for entry in eligible:
+                pool.submit(self.search, entry)
+        with batch_lock:
+            batch_searches.pop(self.view.id(), None)
+        self.view.erase_status(self.status_key)
+        if not self.cancelled:
+            summary = self.summary()
+            sublime.set_timeout(lambda: self.show_summary(summary), 0)
+
+    def search(self, entry):
+        if self.cancelled:
             return
-        resultView = sublime.active_window().new_file()
+        key = self.cache.key(self.scramble, entry['skeleton'], self.algs_dir, self.flags)
+        cached = self.cache.get(key)
+        output = TruncatedOutput(self.output_limit)
+        if cached is not None:
+            output.append(cached)
+        else:
+            writer = self.cache.writer(key)
+            def on_output(text):
+                if writer:
+                    writer.write(text)
+                output.append(text)
+            def callback(error, expired=False):
+                entry['error'] = error
+                if writer:
+                    if error or self.cancelled or expired:
+                        writer.discard()
+                    else:
+                        writer.commit()
+            finder = self.runner(self.scramble, entry['skeleton'], on_output, callback)
+            with self.lock:
+                self.finders.append(finder)
+            if self.cancelled:
+                finder.cancel()
+            finder.run()
+            with self.lock:
+                self.finders.remove(finder)
+        entry['final'] = output.best
+        entry['output'] = output.text()
+        with self.lock:
+            self.done += 1
+        self.show_status()
+
+    def cancel(self):
+        self.cancelled = True
+        with self.lock:
+            finders = self.finders[:]
+        for finder in finders:
+            finder.cancel()
+
+    def show_status(self):
+        eligible = len([entry for entry in self.entries if entry['eligible']])
+        self.view.set_status(self.status_key, 'Finding insertions for all skeletons ({}/{})'.format(self.done, eligible))
+
+    def summary(self):
+        def order(entry):
+            final = entry.get('final')
+            return (not entry['eligible'], final is None, final or 0, entry['line'])
+        parts = []
+        for entry in sorted(self.entries, key=order):
+            if not entry['eligible']:
+                parts.append('Line {}: skipped, {} ({})\n{}\n'.format(entry['line'], entry['reason'], entry['description'], entry['skeleton']))
+                continue
+            final = entry.get('final')
+            part = 'Line {}: {} ({})\n{}\n'.format(entry['line'], '{} moves'.format(final) if final is not None else 'no solution', entry['description'], entry['skeleton'])
+            if entry.get('error'):
+                part += 'Error: {}\n'.format(entry['error'])
+            parts.append(part + entry.get('output', ''))
+        return 'Scramble: {}\n\n{}'.format(self.scramble, '\n'.join(parts))
+
+    def show_summary(self, summary):
+        resultView = (self.view.window() or sublime.active_window()).new_file()
         resultView.set_scratch(True)
-        resultView.run_command('show_solution', {"text": result})
+        resultView.set_name('Insertions for all skeletons')
+        resultView.run_command('show_solution', {"text": summary})
+
+batch_searches = {}
+batch_lock = Lock()
+
+class FindAllInsertionsCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        # analyzing every skeleton and finding the engine take a while,
+        # none of it runs on the UI thread
+        Thread(target=self.start).start()
+
+    def start(self):
+        try:
+            self.search()
+        except Exception:
+            traceback.print_exc()
+            show_error('Unknown error')
+
+    def search(self):
+        view = self.view
+        with batch_lock:
+            if view.id() in batch_searches:
+                show_error('A batch insertion search is already running for this view')
+                return
+            # taken until the search is created
+            batch_searches[view.id()] = None
+        batch = None
+        try:
+            batch = self.prepare()
+        finally:
+            with batch_lock:
+                if batch is None:
+                    batch_searches.pop(view.id(), None)
+                else:
+                    batch_searches[view.id()] = batch
+        if batch is not None:
+            batch.start()
+
+    def prepare(self):
+        """ Returns the batch search of the view's skeletons, None when
+            there is nothing to search. """
+        view = self.view
+        settings = view.settings()
+        document = get_document(view)
+        scramble = document.scramble
+        scrambleCube = FaceletCube(scramble)
+        max_cycles = settings.get('max_cycles', 4)
+        entries = []
+        for block in document.blocks():
+            skeleton = block.skeleton
+            cube = scrambleCube.copy().apply(skeleton)
+            result = analyze_cube(cube)
+            cycles = total_cycles(result)
+            entry = {
+                'line': block.first + 1,
+                'skeleton': skeleton,
+                'state': cube.state,
+                'description': describe_skeleton(skeleton, result),
+                'eligible': True,
+            }
+            if cycles == 0:
+                entry['eligible'] = False
+                entry['reason'] = 'already solved'
+            elif max_cycles != 0 and cycles > max_cycles:
+                entry['eligible'] = False
+                entry['reason'] = 'too many cycles: {}'.format(cycles)
+            entries.append(entry)
+        if not entries:
+            show_error('No skeletons found')
+            return None
+        # skeletons leaving the same cycles to solve, up to a symmetry,
+        # are only searched once, for the shortest of them
+        classes = SymmetryClasses()
+        for entry in sorted(entries, key=lambda entry: (len(entry['skeleton'].split()), entry['line'])):
+            if not entry['eligible']:
+                continue
+            original = classes.add(entry['state'], entry)
+            if original is not entry:
+                entry['eligible'] = False
+                entry['reason'] = duplicate_note(entry['state'], original['state'], original['line'])
+        max_threads = settings.get('max_threads', 2)
+        size = max_threads if max_threads != 0 else (cpu_count() or 1)
+        runner, flags, algs_dir = insertion_engine(settings, '1')
+        return BatchInsertionSearch(view, scramble, entries, runner, flags, algs_dir, size, get_result_cache(settings))
 
     def is_enabled(self):
         return is_fewest_moves(self.view)
 
+class CancelInsertionCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        count = job_manager.cancel(self.view)
+        batch = batch_searches.get(self.view.id())
+        if batch is not None:
+            batch.cancel()
+            count += 1
+        sublime.status_message('Cancelled {} insertion search{}'.format(count, '' if count == 1 else 'es'))
+
+    def is_enabled(self):
+        return len(job_manager.jobs(self.view)) > 0 or self.view.id() in batch_searches
+
+class PerformanceStatsCommand(sublime_plugin.TextCommand):
+    def run(self, edit, reset=False):
+        if reset:
+            stats.reset()
+            sublime.status_message('Fewest Moves performance stats cleared')
+            return
+        resultView = (self.view.window() or sublime.active_window()).new_file()
+        resultView.set_scratch(True)
+        resultView.set_name('Fewest Moves performance stats')
+        resultView.run_command('show_solution', {"text": stats.report()})
+
 class FewestMovesEventListener(sublime_plugin.EventListener):
     def on_activated_async(self, view):
-        self.run_plugin(view)
+        self.run_plugin(view, True)
     def on_load_async(self, view):
-        self.run_plugin(view)
+        self.run_plugin(view, True)
     def on_modified_async(self, view):
-        view.erase_phantoms(phantom_name_line_end)
         self.run_plugin(view)
-    @debounce(1)
-    def run_plugin(self, view):
+    def on_selection_modified_async(self, view):
+        check_viewport(view)
+    def on_post_save_async(self, view):
+        if is_fewest_moves(view):
+            scheduler.schedule(view, 'save_session', save_session, change_count, 0)
+    def on_pre_close(self, view):
         if is_fewest_moves(view):
-            view.run_command('count_moves')
-            view.run_command('draw_scramble')
+            snapshot = session_snapshot(view)
+            if snapshot is not None:
+                cache = get_session_cache(view.settings())
+                sublime.set_timeout_async(lambda: cache.save(*snapshot), 0)
+    def on_close(self, view):
+        forget_scope(view)
+        move_count_caches.pop(view.id(), None)
+        with document_lock:
+            documents.pop(view.id(), None)
+        scheduler.forget(view)
+    def run_plugin(self, view, restore=False):
+        if is_fewest_moves(view):
+            # nothing runs in the background before a Fewest Moves view
+            # shows up
+            start_viewport_polling()
+            settings = view.settings()
+            stats.configure(settings.get('performance_stats', False), settings.get('slow_stage_threshold', 0))
+            if restore:
+                # once per file, before the first refresh
+                scheduler.schedule(view, 'restore_session', restore_session, view_file_name, 0)
+            scheduler.schedule(view, 'count_moves', count_moves, phantom_key)
+            scheduler.schedule(view, 'draw_scramble', draw_scramble, scramble_key)
+            if settings.get('show_cycles', True) and settings.get('flag_duplicates', True):
+                # needs every skeleton of the file, so it runs after the
+                # phantoms and only refreshes them when notes changed
+                scheduler.schedule(view, 'find_duplicates', find_duplicates, change_count)
+
+def count_moves(view):
+    view.run_command('count_moves')
+
+def draw_scramble(view):
+    view.run_command('draw_scramble')
+
+def find_duplicates(view):
+    document = get_document(view)
+    cache = get_move_count_cache(view)
+    # restored sessions already hold the notes of their text
+    if cache.notes_change_count == document.change_count:
+        return
+    with timed('find_duplicates'):
+        changed = cache.find_duplicates(document)
+    if changed:
+        scheduler.schedule(view, 'count_moves', count_moves, phantom_key, 0)
+
+def change_count(view):
+    return view.change_count()
+
+def view_file_name(view):
+    return view.file_name()
+
+# settings the phantoms depend on
+PHANTOM_SETTINGS = ['show_cycles', 'flag_duplicates']
+
+def phantom_key(view):
+    cache = get_move_count_cache(view)
+    settings = view.settings()
+    return (view.change_count(), phantom_window(view, cache), cache.notes_revision) + tuple(settings.get(name) for name in PHANTOM_SETTINGS)
+
+# settings the scramble diagram and its analysis depend on
+SCRAMBLE_SETTINGS = ['u_face', 'r_face', 'f_face', 'd_face', 'l_face', 'b_face', 'analyze_scramble']
+
+def scramble_key(view):
+    settings = view.settings()
+    return (get_scramble(view),) + tuple(settings.get(name) for name in SCRAMBLE_SETTINGS)
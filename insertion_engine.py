@@ -0,0 +1,391 @@
+import multiprocessing
+from operator import ne
+from threading import Lock
+from time import time
+from .move_transformer import MOVE_NAMES, inverse_code, cancel_codes, insert_codes, tokenize, parse_move
+from .facelet_cube import FaceletCube, SOLVED, MOVE_TABLES, gather
+from .cycle_analyzer import CORNER_FACELETS, EDGE_FACELETS, CORNER_LOOKUP, EDGE_LOOKUP, cubies, count_cycles, analyze_cube
+
+# algorithms kept for every 3-cycle
+ALGS_PER_CYCLE = 8
+# solutions reported at most
+MAX_SOLUTIONS = 32
+
+# chunks of subtrees sent to each process of a pool
+CHUNKS_PER_PROCESS = 32
+
+# moves an insertion is assumed to add at least, partial solutions that
+# can't beat the best one with that are pruned
+INSERTION_COST = 2
+
+# pure 3-cycles that short commutators of face turns don't produce
+SEED_ALGS = [
+    "R2 U R U R' U' R' U' R' U R'",
+    "R U' R U R U R U' R' U' R2",
+    "R2 U' F' B R2 F B' U' R2",
+    "L2 U F B' L2 F' B U L2",
+]
+
+def codes_of(sequence):
+    return [axis * 3 + amount - 1 for axis, amount in map(parse_move, tokenize(sequence))]
+
+def sequence_state(codes, state=SOLVED):
+    for code in codes:
+        state = gather(state, MOVE_TABLES[code])
+    return state
+
+def inverse_state(state):
+    inverse = bytearray(54)
+    for position, facelet in enumerate(state):
+        inverse[facelet] = position
+    return bytes(inverse)
+
+def three_cycles(pieces, modulus):
+    """ Returns the states of all 3-cycles of one kind of pieces, with every
+        orientation change that keeps the total orientation. """
+    states = []
+    count = len(pieces)
+    for a in range(count):
+        for b in range(a + 1, count):
+            for c in range(a + 1, count):
+                if c == b:
+                    continue
+                for twistB in range(modulus):
+                    for twistC in range(modulus):
+                        twistA = -(twistB + twistC) % modulus
+                        state = bytearray(SOLVED)
+                        for source, target, twist in ((a, b, twistB), (b, c, twistC), (c, a, twistA)):
+                            for k in range(modulus):
+                                state[pieces[target][k]] = pieces[source][(k + twist) % modulus]
+                        states.append(bytes(state))
+    return states
+
+def canonical_sequences(length):
+    """ Yields move sequences without two turns of the same face in a row
+        and with turns of opposite faces in a fixed order. """
+    if length == 0:
+        yield []
+        return
+    for sequence in canonical_sequences(length - 1):
+        last = sequence[-1] // 3 if sequence else None
+        for code in range(18):
+            axis = code // 3
+            if last is not None and (axis == last or (axis % 3 == last % 3 and axis < last)):
+                continue
+            yield sequence + [code]
+
+class AlgorithmTable:
+    """ Corner and edge 3-cycle algorithms hashed by the state they
+        produce, the shortest ALGS_PER_CYCLE of each kept. """
+
+    def __init__(self):
+        self.algs = {}
+
+    def add(self, codes, state=None):
+        codes = tuple(cancel_codes(codes))
+        if state is None:
+            state = sequence_state(codes)
+        algs = self.algs.setdefault(state, [])
+        if codes in algs:
+            return
+        if len(algs) >= ALGS_PER_CYCLE and len(codes) >= len(algs[-1]):
+            return
+        algs.append(codes)
+        algs.sort(key=len)
+        del algs[ALGS_PER_CYCLE:]
+
+    def get(self, state):
+        return self.algs.get(state)
+
+    def load(self, lines):
+        """ Adds algorithms from text, one per line, keeping only pure corner
+            or edge 3-cycles. """
+        cycles = all_three_cycles()
+        for line in lines:
+            codes = codes_of(line)
+            state = sequence_state(codes)
+            if state in cycles:
+                self.add(codes, state)
+
+    @classmethod
+    def generate(cls, max_setup=3, rounds=4):
+        """ Builds the table from commutators A B A' B' with up to max_setup
+            moves in A and one turn as B plus SEED_ALGS, then conjugates
+            them by single turns for the given number of rounds. """
+        table = cls()
+        cycles = all_three_cycles()
+        for length in range(1, max_setup + 1):
+            for setup in canonical_sequences(length):
+                inverse = [inverse_code(code) for code in reversed(setup)]
+                setupState = sequence_state(setup)
+                inverseState = sequence_state(inverse)
+                for interchange in range(18):
+                    state = gather(gather(gather(setupState, MOVE_TABLES[interchange]), inverseState), MOVE_TABLES[inverse_code(interchange)])
+                    moved = sum(map(ne, state, SOLVED))
+                    if (moved == 6 or moved == 9) and state in cycles:
+                        table.add(setup + [interchange] + inverse + [inverse_code(interchange)], state)
+        table.load(SEED_ALGS)
+        frontier = list(table.algs.items())
+        for round in range(rounds):
+            changed = {}
+            for state, algs in frontier:
+                for code in range(18):
+                    inverse = inverse_code(code)
+                    conjugated = gather(gather(MOVE_TABLES[code], state), MOVE_TABLES[inverse])
+                    before = list(table.algs.get(conjugated, []))
+                    for alg in algs:
+                        table.add([code] + list(alg) + [inverse], conjugated)
+                    if table.algs[conjugated] != before:
+                        changed[conjugated] = table.algs[conjugated]
+            frontier = [(state, list(algs)) for state, algs in changed.items()]
+        return table
+
+algorithm_table = None
+algorithm_table_lock = Lock()
+
+def get_algorithm_table():
+    """ Returns the generated table, built once per process. """
+    global algorithm_table
+    with algorithm_table_lock:
+        if algorithm_table is None:
+            algorithm_table = AlgorithmTable.generate()
+        return algorithm_table
+
+def cycle_targets(cycles, pieces, lookup, modulus):
+    """ Returns (state, permutation, orientation, moved slots) of 3-cycles. """
+    targets = []
+    for state in cycles:
+        permutation, orientation = cubies(state, pieces, lookup)
+        moved = frozenset(slot for slot, piece in enumerate(permutation) if piece != slot)
+        targets.append((state, permutation, orientation, moved))
+    return targets
+
+three_cycle_targets = None
+
+def get_targets():
+    """ Returns the corner and edge 3-cycle targets, built on first use so
+        that loading the plugin doesn't pay for them. """
+    global three_cycle_targets
+    if three_cycle_targets is None:
+        three_cycle_targets = (cycle_targets(three_cycles(CORNER_FACELETS, 3), CORNER_FACELETS, CORNER_LOOKUP, 3),
+                               cycle_targets(three_cycles(EDGE_FACELETS, 2), EDGE_FACELETS, EDGE_LOOKUP, 2))
+    return three_cycle_targets
+
+def all_three_cycles():
+    return set(target[0] for kind in get_targets() for target in kind)
+
+def reducing_cycles(state):
+    """ Returns the number of cycles left in a state and the 3-cycles that
+        reduce it when applied after it. """
+    result = []
+    counts = {}
+    cornerTargets, edgeTargets = get_targets()
+    for pieces, lookup, modulus, targets in ((CORNER_FACELETS, CORNER_LOOKUP, 3, cornerTargets), (EDGE_FACELETS, EDGE_LOOKUP, 2, edgeTargets)):
+        permutation, orientation = cubies(state, pieces, lookup)
+        cycles, parity = count_cycles(permutation, orientation, modulus)
+        counts[modulus] = (cycles, parity)
+        # pieces that are solved or only twisted in place, a useful 3-cycle
+        # moves at least two of the others
+        unsolved = frozenset(slot for slot, piece in enumerate(permutation) if piece != slot or orientation[slot])
+        for target, targetPermutation, targetOrientation, moved in targets:
+            if len(moved & unsolved) < 2:
+                continue
+            newPermutation = [permutation[slot] for slot in targetPermutation]
+            newOrientation = [(orientation[slot] + twist) % modulus for slot, twist in zip(targetPermutation, targetOrientation)]
+            if count_cycles(newPermutation, newOrientation, modulus)[0] < cycles:
+                result.append(target)
+    total = counts[3][0] + counts[2][0] + (1 if counts[3][1] else 0)
+    return total, result
+
+class Bound:
+    """ Length of the best solution found so far, -1 before the first one.
+        Workers of a pool share a multiprocessing.Value instead. """
+
+    def __init__(self):
+        self.value = -1
+        self.lock = Lock()
+
+    def get_lock(self):
+        return self.lock
+
+class Search:
+    """ Depth-first insertion search from a skeleton, only trying 3-cycles
+        that reduce the cycle count and dropping sequences longer than the
+        best solution found so far. """
+
+    def __init__(self, scramble, table, deadline, best):
+        self.scramble = scramble
+        self.table = table
+        self.deadline = deadline
+        self.best = best
+        self.solutions = []
+        self.visited = set()
+        self.expired = False
+        self.cancelled = lambda: False
+
+    def exceeds_bound(self, length):
+        bound = self.best.value
+        return 0 <= bound < length
+
+    def record(self, length, insertions, codes):
+        with self.best.get_lock():
+            if self.exceeds_bound(length):
+                return
+            if self.best.value < 0 or length < self.best.value:
+                self.best.value = length
+        self.solutions = [solution for solution in self.solutions if solution[0] <= length]
+        if len(self.solutions) < MAX_SOLUTIONS:
+            self.solutions.append((length, insertions, codes))
+
+    def children(self, codes, targets):
+        """ Returns (length, sequence, insertion) for every single insertion
+            of one of the target 3-cycles, shortest first. """
+        children = []
+        suffix = SOLVED
+        for gap in range(len(codes), -1, -1):
+            if gap < len(codes):
+                suffix = gather(MOVE_TABLES[codes[gap]], suffix)
+            inverse = inverse_state(suffix)
+            for target in targets:
+                algs = self.table.get(gather(gather(suffix, target), inverse))
+                if not algs:
+                    continue
+                for alg in algs:
+                    sequence = insert_codes(codes, gap, alg)
+                    if self.exceeds_bound(len(sequence)):
+                        continue
+                    key = tuple(sequence)
+                    if key in self.visited:
+                        continue
+                    self.visited.add(key)
+                    children.append((len(sequence), sequence, (gap, alg)))
+        children.sort(key=lambda child: child[0])
+        return children
+
+    def run(self, codes, insertions=()):
+        if time() > self.deadline or self.cancelled():
+            self.expired = True
+            return
+        state = sequence_state(codes, self.scramble)
+        if state == SOLVED:
+            self.record(len(codes), list(insertions), codes)
+            return
+        cycles, targets = reducing_cycles(state)
+        # one insertion removes at most two cycles
+        if self.exceeds_bound(len(codes) + INSERTION_COST * ((cycles + 1) // 2)):
+            return
+        for length, sequence, insertion in self.children(codes, targets):
+            if self.exceeds_bound(length):
+                continue
+            self.run(sequence, list(insertions) + [(codes, insertion)])
+            if self.expired:
+                return
+
+worker_table = None
+worker_best = None
+
+def init_worker(table, best):
+    global worker_table, worker_best
+    worker_table = table
+    worker_best = best
+
+def search_subtrees(chunk):
+    """ Searches consecutive subtrees in one worker, the way the serial
+        search goes through all of them. """
+    scramble, deadline, tasks = chunk
+    search = Search(scramble, worker_table, deadline, worker_best)
+    for codes, insertions in tasks:
+        search.run(codes, insertions)
+        if search.expired:
+            break
+    return search.solutions, search.expired
+
+def find_insertions(scramble, skeleton, table, time_limit=10, processes=0, cancelled=lambda: False):
+    """ Searches insertions of 3-cycles into a skeleton until it is solved.
+
+        Returns (solutions, expired) where each solution is (length,
+        [(sequence, (gap, alg)), ...], final sequence), the searches below
+        the first insertion are spread over a process pool. """
+    scrambleState = sequence_state(codes_of(scramble))
+    codes = codes_of(skeleton)
+    deadline = time() + time_limit
+    root = Search(scrambleState, table, deadline, Bound())
+    state = sequence_state(codes, scrambleState)
+    if state == SOLVED:
+        return [(len(codes), [], codes)], False
+    if analyze_cube(FaceletCube(state=state))['parity']:
+        return [], False
+    tasks = [(sequence, [(codes, insertion)]) for length, sequence, insertion in root.children(codes, reducing_cycles(state)[1])]
+    processes = processes or multiprocessing.cpu_count() or 1
+    results = []
+    pool = None
+    if processes > 1 and len(tasks) > 1:
+        try:
+            best = multiprocessing.Value('i', -1)
+            pool = multiprocessing.Pool(processes, init_worker, (table, best))
+        except (OSError, ImportError, ValueError):
+            pool = None
+    if pool is not None:
+        try:
+            # one message per subtree costs more than most subtrees take
+            # once a bound prunes them, and kept the pool sending subtrees
+            # to expire long after the deadline
+            size = max(1, len(tasks) // (processes * CHUNKS_PER_PROCESS))
+            chunks = [(scrambleState, deadline, tasks[i:i + size]) for i in range(0, len(tasks), size)]
+            pending = pool.imap_unordered(search_subtrees, chunks)
+            while True:
+                if cancelled():
+                    pool.terminate()
+                    return [], False
+                try:
+                    results.append(pending.next(0.1))
+                except multiprocessing.TimeoutError:
+                    continue
+                except StopIteration:
+                    break
+        finally:
+            pool.terminate()
+    else:
+        search = Search(scrambleState, table, deadline, root.best)
+        search.visited = root.visited
+        search.cancelled = cancelled
+        for task in tasks:
+            if cancelled():
+                return [], False
+            search.run(*task)
+            if search.expired:
+                break
+        results.append((search.solutions, search.expired))
+    solutions = [solution for found, expired in results for solution in found]
+    expired = any(expired for found, expired in results)
+    if not solutions:
+        return [], expired
+    best = min(solution[0] for solution in solutions)
+    solutions.sort(key=lambda solution: [alg for sequence, (gap, alg) in solution[1]])
+    # insertions made in another order often end in the same solution
+    unique = {}
+    for solution in solutions:
+        if solution[0] == best:
+            unique.setdefault(tuple(solution[2]), solution)
+    return list(unique.values())[:MAX_SOLUTIONS], expired
+
+def format_moves(codes):
+    return ' '.join([MOVE_NAMES[code] for code in codes])
+
+def format_result(scramble, skeleton, solutions, expired, time_limit):
+    """ Formats solutions the way `insertionfinder -s` prints them. """
+    lines = ['Scramble: {}'.format(scramble), 'Skeleton: {}'.format(skeleton)]
+    if expired:
+        lines.append('Time limit of {} seconds reached, results may not be optimal.'.format(time_limit))
+    if not solutions:
+        lines.append('No solution found.')
+        return '\n'.join(lines) + '\n'
+    for length, insertions, codes in solutions:
+        lines.append('')
+        lines.append('Total moves: {}, {} insertion{}'.format(length, len(insertions), '' if len(insertions) == 1 else 's'))
+        for sequence, (gap, alg) in insertions:
+            lines.append('{} [{}] {}'.format(format_moves(sequence[:gap]), format_moves(alg), format_moves(sequence[gap:])).strip())
+        lines.append('Solution: {}'.format(format_moves(codes)))
+    lines.append('')
+    lines.append('Fewest moves: {}'.format(solutions[0][0]))
+    return '\n'.join(lines) + '\n'
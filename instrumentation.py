@@ -0,0 +1,104 @@
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+# upper bounds in milliseconds of the histogram buckets, the last one
+# takes everything slower
+BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, float('inf')]
+
+class Histogram:
+    """ Durations of one stage, counted in buckets of doubling width. """
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, milliseconds):
+        for index, bound in enumerate(BUCKETS):
+            if milliseconds < bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.total += milliseconds
+        self.max = max(self.max, milliseconds)
+
+    def percentile(self, fraction):
+        """ Returns the upper bound of the bucket holding the percentile,
+            the maximum for the last bucket. """
+        target = fraction * self.count
+        seen = 0
+        for count, bound in zip(self.counts, BUCKETS):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+class Stats:
+    """ Histograms of the duration of every stage, recorded only while
+        enabled. Stages slower than threshold milliseconds are printed to
+        the console either way, 0 prints nothing. """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.histograms = {}
+        self.enabled = False
+        self.threshold = 0
+
+    def configure(self, enabled, threshold):
+        self.enabled = enabled
+        self.threshold = threshold
+
+    @property
+    def active(self):
+        return self.enabled or self.threshold > 0
+
+    def record(self, stage, seconds, warn=True):
+        milliseconds = seconds * 1000
+        if self.enabled:
+            with self.lock:
+                histogram = self.histograms.get(stage)
+                if histogram is None:
+                    histogram = self.histograms[stage] = Histogram()
+                histogram.add(milliseconds)
+        if warn and self.threshold and milliseconds > self.threshold:
+            print('Fewest Moves: {} took {:.1f} ms'.format(stage, milliseconds))
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def report(self):
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            lines = ['{:<22} {:>7} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('stage (ms)', 'count', 'mean', 'p50', 'p90', 'p99', 'max')]
+            for stage, histogram in histograms:
+                lines.append('{:<22} {:>7} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(stage, histogram.count, histogram.total / histogram.count, histogram.percentile(0.5), histogram.percentile(0.9), histogram.percentile(0.99), histogram.max))
+            lines.append('')
+            lines.append('Percentiles are bucket bounds: {} ms.'.format(', '.join(str(bound) for bound in BUCKETS[:-1])))
+            if not histograms:
+                lines.insert(1, 'No timings recorded yet.' if self.enabled else 'Set "performance_stats" to true to record timings.')
+            for stage, histogram in histograms:
+                lines.append('')
+                lines.append(stage)
+                lower = 0
+                for count, bound in zip(histogram.counts, BUCKETS):
+                    if count:
+                        lines.append('  {:>6} - {:<6} {}'.format(lower, bound if bound != float('inf') else '', count))
+                    lower = bound
+            return '\n'.join(lines) + '\n'
+
+stats = Stats()
+
+@contextmanager
+def timed(stage):
+    """ Records the time spent in the block under a stage name. """
+    if not stats.active:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        stats.record(stage, perf_counter() - start)
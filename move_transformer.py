@@ -1,4 +1,5 @@
 import re
+from functools import lru_cache
 
 AXES = 'URFDLB'
 ROTATIONS = ['y', 'x', 'z']
@@ -6,79 +7,128 @@ ROTATIONS = ['y', 'x', 'z']
 # orientations:
 # UF UR UB UL FD FR FU FL DB DR DF DL BU BR BD BL RF RD RB RU LF LU LB LD
 #  0  1  2  3  4  5  6  7  8  9 10 11 12 13 14 15 16 17 18 19 20 21 22 23
+# REORIENT[orientation][axis] is the orientation after a quarter rotation
+# around ROTATIONS[axis]
+REORIENT = [
+    [1, 4, 20],
+    [2, 17, 5],
+    [3, 14, 18],
+    [0, 23, 15],
+    [5, 8, 23],
+    [6, 18, 9],
+    [7, 2, 19],
+    [4, 22, 3],
+    [9, 12, 22],
+    [10, 19, 13],
+    [11, 6, 16],
+    [8, 21, 7],
+    [13, 0, 21],
+    [14, 16, 1],
+    [15, 10, 17],
+    [12, 20, 11],
+    [17, 7, 0],
+    [18, 11, 4],
+    [19, 15, 8],
+    [16, 3, 12],
+    [21, 5, 10],
+    [22, 1, 6],
+    [23, 13, 2],
+    [20, 9, 14],
+]
+
+# the face each of U, R, F turns into under every orientation
+FACE_MAPPING = {
+    'U': [
+        'U', 'U', 'U', 'U',
+        'F', 'F', 'F', 'F',
+        'D', 'D', 'D', 'D',
+        'B', 'B', 'B', 'B',
+        'R', 'R', 'R', 'R',
+        'L', 'L', 'L', 'L',
+    ],
+    'R': [
+        'R', 'B', 'L', 'F',
+        'R', 'U', 'L', 'D',
+        'R', 'F', 'L', 'B',
+        'R', 'D', 'L', 'U',
+        'D', 'B', 'U', 'F',
+        'U', 'B', 'D', 'F',
+    ],
+    'F': [
+        'F', 'R', 'B', 'L',
+        'D', 'R', 'U', 'L',
+        'B', 'R', 'F', 'L',
+        'U', 'R', 'D', 'L',
+        'F', 'D', 'B', 'U',
+        'F', 'U', 'B', 'D',
+    ],
+}
+
+# move codes: axis * 3 + amount - 1 for face turns,
+# 18 + rotation * 3 + amount - 1 for rotations
+MOVE_NAMES = [axis + suffix for axis in AXES for suffix in ['', '2', "'"]]
+
+def inverse_code(code):
+    return code - code % 3 + 2 - code % 3
+
+def build_orientation_tables():
+    # shortest rotation sequence leading from orientation 0 to each orientation
+    words = {0: []}
+    queue = [0]
+    for current in queue:
+        for axis in range(3):
+            next = REORIENT[current][axis]
+            if next not in words:
+                words[next] = words[current] + [axis]
+                queue.append(next)
+    compose = []
+    for current in range(24):
+        row = []
+        for target in range(24):
+            next = current
+            for axis in words[target]:
+                next = REORIENT[next][axis]
+            row.append(next)
+        compose.append(row)
+    rotations = []
+    for axis in range(3):
+        next = 0
+        for amount in range(3):
+            next = REORIENT[next][axis]
+            rotations.append(next)
+    oriented = []
+    for orientation in range(24):
+        row = []
+        for code in range(18):
+            axis = code // 3
+            face = FACE_MAPPING[AXES[axis % 3]][orientation]
+            if axis >= 3:
+                face = AXES[(AXES.index(face) + 3) % 6]
+            row.append(AXES.index(face) * 3 + code % 3)
+        oriented.append(row)
+    return compose, rotations, oriented
+
+# COMPOSE_ORIENTATIONS[a][b] is the orientation reached from a by applying
+# the rotations that lead from orientation 0 to b,
+# ROTATION_ORIENTATIONS[rotation * 3 + amount - 1] the orientation reached
+# from 0 by a rotation and ORIENTED_MOVES[orientation][code] the move code a
+# face turn becomes once the orientation is undone
+COMPOSE_ORIENTATIONS, ROTATION_ORIENTATIONS, ORIENTED_MOVES = build_orientation_tables()
+
 def reorient(current, axis, amount):
-    MAPPING = [
-        [1, 4, 20],
-        [2, 17, 5],
-        [3, 14, 18],
-        [0, 23, 15],
-        [5, 8, 23],
-        [6, 18, 9],
-        [7, 2, 19],
-        [4, 22, 3],
-        [9, 12, 22],
-        [10, 19, 13],
-        [11, 6, 16],
-        [8, 21, 7],
-        [13, 0, 21],
-        [14, 16, 1],
-        [15, 10, 17],
-        [12, 20, 11],
-        [17, 7, 0],
-        [18, 11, 4],
-        [19, 15, 8],
-        [16, 3, 12],
-        [21, 5, 10],
-        [22, 1, 6],
-        [23, 13, 2],
-        [20, 9, 14],
-    ]
-    next = current
-    for i in range(amount):
-        next = MAPPING[next][axis]
-    return next
+    amount %= 4
+    if amount == 0:
+        return current
+    return COMPOSE_ORIENTATIONS[current][ROTATION_ORIENTATIONS[axis * 3 + amount - 1]]
 
 def oriented_move(move, orientation):
-    MAPPING = {
-        'U': [
-            'U', 'U', 'U', 'U',
-            'F', 'F', 'F', 'F',
-            'D', 'D', 'D', 'D',
-            'B', 'B', 'B', 'B',
-            'R', 'R', 'R', 'R',
-            'L', 'L', 'L', 'L',
-        ],
-        'R': [
-            'R', 'B', 'L', 'F',
-            'R', 'U', 'L', 'D',
-            'R', 'F', 'L', 'B',
-            'R', 'D', 'L', 'U',
-            'D', 'B', 'U', 'F',
-            'U', 'B', 'D', 'F',
-        ],
-        'F': [
-            'F', 'R', 'B', 'L',
-            'D', 'R', 'U', 'L',
-            'B', 'R', 'F', 'L',
-            'U', 'R', 'D', 'L',
-            'F', 'D', 'B', 'U',
-            'F', 'U', 'B', 'D',
-        ],
-    }
     axis = AXES.index(move[:1])
-    suffix = move[1:]
-    opposite = False
-    if axis >= 3:
-        opposite = True
-        axis %= 3
-    newFace = MAPPING[AXES[axis]][orientation]
-    if opposite:
-        newAxis = (AXES.index(newFace) + 3) % 6
-        newFace = AXES[newAxis]
-    return newFace + suffix
+    return AXES[ORIENTED_MOVES[orientation][axis * 3] // 3] + move[1:]
+
+move_pattern = re.compile(r"((?:2?[URFDLB]w|[URFDLBxyz])['2]?|\[[urfdlb]['2]?\]|[Nn][Ii][Ss][Ss])")
+irregular_move_pattern = re.compile(r"^(?:2?([URFDLB]w)(['2]?)|\[([urfdlb])(['2]?)\])$")
 
 def tokenize(sequence):
-    move_pattern = re.compile(r"((?:2?[URFDLB]w|[URFDLBxyz])['2]?|\[[urfdlb]['2]?\]|[Nn][Ii][Ss][Ss])")
     return move_pattern.findall(sequence)
 
 def parse_move(move):
@@ -127,7 +177,6 @@ def equivalence_mapping(move, suffix):
     return result
 
 def standardize(sequence):
-    irregular_move_pattern = re.compile(r"^(?:2?([URFDLB]w)(['2]?)|\[([urfdlb])(['2]?)\])$")
     result = []
     for move in sequence:
         match = irregular_move_pattern.search(move)
@@ -143,63 +192,102 @@ def standardize(sequence):
     return result
 
 def regularize(sequence):
-    tmp = standardize(sequence)
+    codes = []
+    for move in standardize(sequence):
+        codes += token_codes(move)
+    return [MOVE_NAMES[code] for code in regularize_codes(codes)]
+
+token_code_cache = {}
 
+def token_codes(token):
+    """ Returns the move codes a token stands for, outer block turns and
+        slices are expanded to face turns and rotations. """
+    codes = token_code_cache.get(token)
+    if codes is None:
+        codes = []
+        for move in standardize([token]):
+            amount = suffix2amount(move[1:])
+            if move[:1] in ROTATIONS:
+                codes.append(18 + ROTATIONS.index(move[:1]) * 3 + amount - 1)
+            else:
+                codes.append(AXES.index(move[:1]) * 3 + amount - 1)
+        codes = tuple(codes)
+        token_code_cache[token] = codes
+    return codes
+
+def regularize_codes(codes):
     result = []
     orientation = 0
-    for move in tmp:
-        axis = move[:1]
-        amount = suffix2amount(move[1:])
-        if axis in ROTATIONS:
-            orientation = reorient(orientation, ROTATIONS.index(axis), amount)
+    for code in codes:
+        if code >= 18:
+            orientation = COMPOSE_ORIENTATIONS[orientation][ROTATION_ORIENTATIONS[code - 18]]
             continue
-        result.append(oriented_move(move, orientation))
+        result.append(ORIENTED_MOVES[orientation][code])
     return result
 
+def push_code(result, code):
+    """ Appends a move code to a cancelled sequence, returns False if it
+        merged with or cancelled a previous move instead. """
+    axis = code // 3
+    amount = code % 3 + 1
+    if len(result) > 0:
+        lastAxis = result[-1] // 3
+        if axis == lastAxis:
+            amount = (amount + result[-1] % 3 + 1) % 4
+            if amount == 0:
+                del result[-1]
+            else:
+                result[-1] = axis * 3 + amount - 1
+            return False
+        elif len(result) > 1 and axis % 3 == lastAxis % 3 and axis == result[-2] // 3:
+            amount = (amount + result[-2] % 3 + 1) % 4
+            if amount == 0:
+                del result[-2]
+            else:
+                result[-2] = axis * 3 + amount - 1
+            return False
+    result.append(code)
+    return True
+
+def cancel_codes(codes):
+    result = []
+    for code in codes:
+        push_code(result, code)
+    return result
+
+def insert_codes(codes, position, inserted):
+    """ Inserts moves into a cancelled sequence, only cancelling around
+        the insertion point. """
+    result = codes[:position]
+    for code in inserted:
+        push_code(result, code)
+    rest = codes[position:]
+    appended = 0
+    for index, code in enumerate(rest):
+        if push_code(result, code):
+            appended += 1
+            # the last two moves are neighbours in the original sequence,
+            # which doesn't cancel any further
+            if appended == 2:
+                return result + rest[index + 1:]
+        else:
+            appended = 0
+    return result
+
+@lru_cache(maxsize=1024)
 def normalize(sequence):
-    tokens = tokenize(sequence)
     normal_sequence = []
     inverse_sequence = []
     inverse = False
-    for token in tokens:
+    for token in tokenize(sequence):
         if token.upper() == 'NISS':
             inverse = not inverse
             continue
         if inverse:
-            inverse_sequence.append(token)
+            inverse_sequence.append(token_codes(token))
         else:
-            normal_sequence.append(token)
-    reverse = standardize(inverse_sequence[::-1])
-    for move in reverse:
-        if move.endswith("'"):
-            normal_sequence.append(move[:-1])
-        elif move.endswith("2"):
-            normal_sequence.append(move)
-        else:
-            normal_sequence.append(move + "'")
-    normal_sequence = regularize(normal_sequence)
-    result = []
-    for move in normal_sequence:
-        axis, amount = parse_move(move)
-        if len(result) > 0:
-            lastAxis, lastAmount = parse_move(result[-1])
-            if axis == lastAxis:
-                amount += lastAmount
-                amount %= 4
-                if amount == 0:
-                    del result[-1]
-                else:
-                    result[-1] = compose_move(axis, amount)
-                continue
-            elif len(result) > 1 and axis % 3 == lastAxis % 3:
-                previousAxis, previousAmount = parse_move(result[-2])
-                if axis == previousAxis:
-                    amount += previousAmount
-                    amount %= 4
-                    if amount == 0:
-                        del result[-2]
-                    else:
-                        result[-2] = compose_move(axis, amount)
-                    continue
-        result.append(move)
-    return ' '.join(result)
+            normal_sequence += token_codes(token)
+    for codes in reversed(inverse_sequence):
+        normal_sequence += [inverse_code(code) for code in codes]
+    result = cancel_codes(regularize_codes(normal_sequence))
+    return ' '.join([MOVE_NAMES[code] for code in result])
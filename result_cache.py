@@ -0,0 +1,135 @@
+import os
+from hashlib import sha1
+from json import dumps
+from threading import Lock
+
+class ResultCache:
+    """ Insertion finder outputs stored on disk, the least recently used
+        ones are removed once they take more than max_size bytes. """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = Lock()
+        self.fingerprints = {}
+
+    def key(self, scramble, skeleton, algs_dir, flags):
+        """ Returns the cache key of a search, flags being the command line
+            without options that don't change its output. """
+        fingerprint = self.algs_fingerprint(algs_dir) if algs_dir else None
+        data = dumps([scramble, skeleton, fingerprint, flags])
+        return sha1(data.encode()).hexdigest()
+
+    def algs_fingerprint(self, algs_dir):
+        """ Hashes the contents of the algs directory, reusing the digest
+            of files whose size and modification time are unchanged. """
+        digest = sha1()
+        for root, dirs, files in os.walk(algs_dir):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                signature = (path, stat.st_size, stat.st_mtime)
+                fileDigest = self.fingerprints.get(signature)
+                if fileDigest is None:
+                    fileHash = sha1()
+                    try:
+                        with open(path, 'rb') as f:
+                            for chunk in iter(lambda: f.read(65536), b''):
+                                fileHash.update(chunk)
+                    except OSError:
+                        continue
+                    fileDigest = self.fingerprints[signature] = fileHash.hexdigest()
+                digest.update(os.path.relpath(path, algs_dir).encode())
+                digest.update(fileDigest.encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.txt')
+
+    def get(self, key):
+        if self.max_size <= 0:
+            return None
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                text = f.read().decode()
+            os.utime(path, None)
+        except (OSError, UnicodeDecodeError):
+            return None
+        return text
+
+    def writer(self, key):
+        if self.max_size <= 0:
+            return None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            return CacheWriter(self, key)
+        except OSError:
+            return None
+
+    def evict(self):
+        with self.lock:
+            evict_files(self.directory, '.txt', self.max_size)
+
+def evict_files(directory, extension, max_size):
+    """ Removes the least recently used files of a directory ending with
+        extension until they take at most max_size bytes. """
+    entries = []
+    for name in os.listdir(directory):
+        if not name.endswith(extension):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+class CacheWriter:
+    """ Writes an output to a temporary file as it arrives, the entry only
+        shows up in the cache once committed. """
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.temp_path = '{}.{}.tmp'.format(cache.path(key), id(self))
+        self.file = open(self.temp_path, 'wb')
+
+    def write(self, text):
+        if self.file is not None:
+            self.file.write(text.encode())
+
+    def commit(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        try:
+            os.replace(self.temp_path, self.cache.path(self.key))
+        except OSError:
+            self.discard()
+            return
+        self.cache.evict()
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
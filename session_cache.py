@@ -0,0 +1,69 @@
+import os
+import marshal
+import zlib
+from hashlib import sha1
+from threading import Lock
+from .result_cache import evict_files
+
+# session files start with MAGIC, files of another format version are
+# ignored and replaced when the file is next saved
+MAGIC = b'FMS\x03'
+# marshal format version, versions 3 and 4 need Python 3.4 while Sublime
+# Text runs plugins on Python 3.3
+MARSHAL_VERSION = 2
+
+def content_digest(text):
+    return sha1(text.encode()).digest()
+
+class SessionCache:
+    """ What the plugin worked out for each file, stored on disk by path
+        as zlib compressed marshal data. The least recently used sessions
+        are removed once they take more than max_size bytes. """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = Lock()
+
+    def path(self, file_name):
+        return os.path.join(self.directory, sha1(file_name.encode()).hexdigest() + '.session')
+
+    def load(self, file_name):
+        """ Returns the session dict of a file, None when there is none or
+            it can't be read. """
+        if self.max_size <= 0:
+            return None
+        path = self.path(file_name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)
+        except OSError:
+            return None
+        if not data.startswith(MAGIC):
+            return None
+        try:
+            session = marshal.loads(zlib.decompress(data[len(MAGIC):]))
+        except (ValueError, EOFError, TypeError, zlib.error):
+            return None
+        return session if isinstance(session, dict) else None
+
+    def save(self, file_name, session):
+        if self.max_size <= 0:
+            return
+        path = self.path(file_name)
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            data = MAGIC + zlib.compress(marshal.dumps(session, MARSHAL_VERSION))
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temporary, 'wb') as f:
+                f.write(data)
+            os.replace(temporary, path)
+        except (OSError, ValueError):
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+            return
+        with self.lock:
+            evict_files(self.directory, '.session', self.max_size)
@@ -0,0 +1,328 @@
+import os
+from mmap import mmap, ACCESS_READ
+from operator import add
+from threading import Lock
+from time import time
+from .facelet_cube import FaceletCube, MOVE_TABLES
+from .cubie_cube import CubieCube, binomial, coordinate_move_table
+from .cycle_analyzer import CORNER_FACELETS, EDGE_FACELETS, CENTER_FACELETS
+from .symmetry import SYMMETRY_TABLES, conjugate
+from .move_transformer import MOVE_NAMES
+
+# sub-steps of the first line's scramble are solved with IDA*, every
+# step being a set of variants that only differ by a symmetry: the state
+# is conjugated so that the variant becomes the one the coordinates and
+# pruning tables are written for, and the solution is conjugated back
+
+SLICES = binomial(12, 4)
+
+# FOLLOWERS[last] are the moves searched after the move last, 18 at the
+# start: never the same face twice, opposite faces in one order only
+FOLLOWERS = []
+for last in range(19):
+    FOLLOWERS.append([code for code in range(18) if last == 18 or (code // 3 != last // 3 and code // 3 + 3 != last // 3)])
+
+class Expired(Exception):
+    pass
+
+# pruning tables, distances to the goal stored as one byte per index
+
+class PruningTables:
+    """ Pruning tables by name, memory mapped from directory once built,
+        kept in memory when directory is None. """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = Lock()
+        self.tables = {}
+
+    def get(self, name, size, build):
+        with self.lock:
+            table = self.tables.get(name)
+            if table is None:
+                table = self.load(name, size)
+                if table is None:
+                    table = build()
+                    table = self.save(name, table)
+                self.tables[name] = table
+            return table
+
+    def path(self, name):
+        return os.path.join(self.directory, name + '.prune')
+
+    def load(self, name, size):
+        if self.directory is None:
+            return None
+        try:
+            with open(self.path(name), 'rb') as f:
+                table = mmap(f.fileno(), 0, access=ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        if len(table) != size:
+            table.close()
+            return None
+        return table
+
+    def save(self, name, table):
+        if self.directory is None:
+            return bytes(table)
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = self.path(name) + '.{}.tmp'.format(os.getpid())
+        with open(temporary, 'wb') as f:
+            f.write(table)
+        os.replace(temporary, self.path(name))
+        return self.load(name, len(table))
+
+def breadth_first(size, start, neighbours):
+    """ Returns the distance of every index to start, 255 for indices
+        that can't be reached. """
+    table = bytearray(b'\xff') * size
+    table[start] = 0
+    frontier = [start]
+    depth = 0
+    while frontier:
+        depth += 1
+        found = []
+        for index in frontier:
+            for neighbour in neighbours(index):
+                if table[neighbour] == 255:
+                    table[neighbour] = depth
+                    found.append(neighbour)
+        frontier = found
+    return table
+
+# stickers are tracked by position, which gives a piece's slot and
+# orientation at once and needs no orientation convention
+
+CORNER_STICKERS = [facelet for facelets in CORNER_FACELETS for facelet in facelets]
+EDGE_STICKERS = [facelet for facelets in EDGE_FACELETS for facelet in facelets]
+
+def sticker_move_table(stickers):
+    """ table[index * 18 + code] is the index of the sticker position a
+        move takes the sticker at stickers[index] to. """
+    table = []
+    for sticker in stickers:
+        for move in MOVE_TABLES:
+            table.append(stickers.index(move.index(sticker)))
+    return table
+
+CORNER_STICKER_MOVES = sticker_move_table(CORNER_STICKERS)
+EDGE_STICKER_MOVES = sticker_move_table(EDGE_STICKERS)
+
+def symmetry_to(facelets, targets):
+    """ Returns the first symmetry mapping the set of facelets onto the
+        set of targets. """
+    targets = set(targets)
+    for symmetry, table in enumerate(SYMMETRY_TABLES):
+        if set(table[facelet] for facelet in facelets) == targets:
+            return symmetry
+    raise ValueError('no symmetry maps {} to {}'.format(facelets, targets))
+
+move_maps = {}
+
+def move_map(symmetry):
+    """ Returns the move codes seen through a symmetry. """
+    codes = move_maps.get(symmetry)
+    if codes is None:
+        codes = [MOVE_TABLES.index(conjugate(table, symmetry)) for table in MOVE_TABLES]
+        move_maps[symmetry] = codes
+    return codes
+
+def inverse_symmetry(symmetry):
+    table = SYMMETRY_TABLES[symmetry]
+    for inverse, other in enumerate(SYMMETRY_TABLES):
+        if all(other[table[facelet]] == facelet for facelet in range(54)):
+            return inverse
+
+class Step:
+    """ A goal reached from any state. Subclasses define
+        coordinates(state) reading a facelet state, move(coordinates,
+        code) turning them and estimate(coordinates) bounding the moves
+        left, 0 only once the goal is reached. prepare(tables) loads the
+        tables they need, building them when needed. variants are (label,
+        symmetry) pairs. """
+
+    name = None
+    variants = []
+
+    def prepare(self, tables):
+        pass
+
+class BlockStep(Step):
+    """ A 2x2x2 block, a corner and its three edges, around any of the
+        eight corners. """
+
+    name = '2x2x2'
+    # the DBL block, its D and B stickers tracked
+    STICKERS = (33, 30, 34, 50)
+    SIZE = 24 ** 4
+
+    def __init__(self):
+        corners = ['URF', 'UFL', 'ULB', 'UBR', 'DFR', 'DLF', 'DBL', 'DRB']
+        reference = self.block_facelets(6)
+        self.variants = [(corners[corner], symmetry_to(self.block_facelets(corner), reference)) for corner in range(8)]
+        self.table = None
+
+    @staticmethod
+    def block_facelets(corner):
+        faces = set(facelet // 9 for facelet in CORNER_FACELETS[corner])
+        facelets = list(CORNER_FACELETS[corner])
+        for edge in EDGE_FACELETS:
+            if set(facelet // 9 for facelet in edge) <= faces:
+                facelets.extend(edge)
+        return facelets
+
+    def prepare(self, tables):
+        self.table = tables.get('block_2x2x2', self.SIZE, self.build)
+
+    def build(self):
+        def neighbours(index):
+            index, e3 = divmod(index, 24)
+            index, e2 = divmod(index, 24)
+            c, e1 = divmod(index, 24)
+            return [((CORNER_STICKER_MOVES[c * 18 + code] * 24 + EDGE_STICKER_MOVES[e1 * 18 + code]) * 24 + EDGE_STICKER_MOVES[e2 * 18 + code]) * 24 + EDGE_STICKER_MOVES[e3 * 18 + code] for code in range(18)]
+        return breadth_first(self.SIZE, self.coordinates(bytes(range(54))), neighbours)
+
+    def coordinates(self, state):
+        corner, e1, e2, e3 = [state.index(sticker) for sticker in self.STICKERS]
+        return ((CORNER_STICKERS.index(corner) * 24 + EDGE_STICKERS.index(e1)) * 24 + EDGE_STICKERS.index(e2)) * 24 + EDGE_STICKERS.index(e3)
+
+    def move(self, index, code):
+        index, e3 = divmod(index, 24)
+        index, e2 = divmod(index, 24)
+        c, e1 = divmod(index, 24)
+        return ((CORNER_STICKER_MOVES[c * 18 + code] * 24 + EDGE_STICKER_MOVES[e1 * 18 + code]) * 24 + EDGE_STICKER_MOVES[e2 * 18 + code]) * 24 + EDGE_STICKER_MOVES[e3 * 18 + code]
+
+    def estimate(self, index):
+        return self.table[index]
+
+class OrientationStep(Step):
+    """ Edge orientation, on the F/B axis in the flip coordinate. """
+
+    name = 'EO'
+
+    def __init__(self):
+        fb = (CENTER_FACELETS[2], CENTER_FACELETS[5])
+        self.variants = [(label, symmetry_to((CENTER_FACELETS[axis], CENTER_FACELETS[axis + 3]), fb)) for label, axis in (('fb', 2), ('rl', 1), ('ud', 0))]
+        self.flips = None
+        self.table = None
+
+    def prepare(self, tables):
+        self.flips = coordinate_move_table('flip')
+        flips = self.flips
+        self.table = tables.get('flip', 2 ** 11, lambda: breadth_first(2 ** 11, 0, lambda flip: flips[flip * 18:flip * 18 + 18]))
+
+    def coordinates(self, state):
+        return CubieCube.from_facelet(FaceletCube(state=state)).flip()
+
+    def move(self, flip, code):
+        return self.flips[flip * 18 + code]
+
+    def estimate(self, flip):
+        return self.table[flip]
+
+class DominoStep(Step):
+    """ Domino reduction on the U/D axis, corners and edges oriented and
+        the E slice edges in the E slice, with edges oriented on the F/B
+        axis. """
+
+    name = 'DR'
+
+    def __init__(self):
+        ud = (CENTER_FACELETS[0], CENTER_FACELETS[3])
+        self.variants = [(label, symmetry_to((CENTER_FACELETS[axis], CENTER_FACELETS[axis + 3]), ud)) for label, axis in (('ud', 0), ('fb', 2), ('rl', 1))]
+        self.twists = None
+        self.flips = None
+        self.slices = None
+        self.twist_slice = None
+        self.flip_slice = None
+
+    def prepare(self, tables):
+        self.twists = coordinate_move_table('twist')
+        self.flips = coordinate_move_table('flip')
+        self.slices = coordinate_move_table('slice')
+        self.twist_slice = tables.get('twist_slice', 3 ** 7 * SLICES, lambda: self.build(self.twists, 3 ** 7))
+        self.flip_slice = tables.get('flip_slice', 2 ** 11 * SLICES, lambda: self.build(self.flips, 2 ** 11))
+
+    def build(self, moves, size):
+        slices = self.slices
+        # coordinates premultiplied by the number of slice coordinates
+        scaled = [coordinate * SLICES for coordinate in moves]
+        def neighbours(index):
+            coordinate, slice = divmod(index, SLICES)
+            return map(add, scaled[coordinate * 18:coordinate * 18 + 18], slices[slice * 18:slice * 18 + 18])
+        return breadth_first(size * SLICES, 0, neighbours)
+
+    def coordinates(self, state):
+        cube = CubieCube.from_facelet(FaceletCube(state=state))
+        return (cube.twist(), cube.flip(), cube.slice())
+
+    def move(self, coordinates, code):
+        twist, flip, slice = coordinates
+        return (self.twists[twist * 18 + code], self.flips[flip * 18 + code], self.slices[slice * 18 + code])
+
+    def estimate(self, coordinates):
+        twist, flip, slice = coordinates
+        return max(self.twist_slice[twist * SLICES + slice], self.flip_slice[flip * SLICES + slice])
+
+steps = None
+
+def get_steps():
+    """ Returns the steps shown below the scramble diagram, created on
+        first use so that loading the plugin doesn't look for symmetries. """
+    global steps
+    if steps is None:
+        steps = [BlockStep(), OrientationStep(), DominoStep()]
+    return steps
+
+class StepSearch:
+    """ Iterative deepening over all variants of a step at once, so the
+        shortest solutions of the step are found without finishing the
+        search of every variant. """
+
+    # nodes between checks of the deadline
+    CHECK_INTERVAL = 4096
+
+    def __init__(self, step, state, deadline=None, cancelled=lambda: False):
+        self.step = step
+        self.deadline = deadline
+        self.cancelled = cancelled
+        self.nodes = 0
+        self.starts = [(label, symmetry, step.coordinates(conjugate(state, symmetry))) for label, symmetry in step.variants]
+
+    def run(self, max_length=20):
+        """ Returns (length, solutions, complete), solutions being one
+            (variant, moves) pair for each variant solved in the fewest
+            moves. When time runs out, complete is False and solutions
+            only holds the variants searched so far at length, none when
+            length moves were not enough for them. """
+        for depth in range(max_length + 1):
+            solutions = []
+            try:
+                for label, symmetry, start in self.starts:
+                    path = []
+                    if self.search(start, depth, 18, path):
+                        codes = move_map(inverse_symmetry(symmetry))
+                        solutions.append((label, ' '.join(MOVE_NAMES[codes[code]] for code in path)))
+            except Expired:
+                return depth, solutions, False
+            if solutions:
+                return depth, solutions, True
+        return max_length + 1, [], True
+
+    def search(self, coordinates, depth, last, path):
+        step = self.step
+        distance = step.estimate(coordinates)
+        if distance > depth:
+            return False
+        if depth == 0:
+            return True
+        self.nodes += 1
+        if self.nodes % self.CHECK_INTERVAL == 0 and (self.cancelled() or (self.deadline is not None and time() > self.deadline)):
+            raise Expired()
+        for code in FOLLOWERS[last]:
+            path.append(code)
+            if self.search(step.move(coordinates, code), depth - 1, code, path):
+                return True
+            path.pop()
+        return False
@@ -0,0 +1,99 @@
+from functools import lru_cache
+from itertools import permutations, product
+from operator import itemgetter
+
+def facelet_position(facelet):
+    """ Returns the position of a facelet's center with the cube spanning
+        -1.5 to 1.5, x pointing to R, y to U and z to F. Coordinates are
+        doubled to stay integers. """
+    face, index = divmod(facelet, 9)
+    row, col = divmod(index, 3)
+    # U, R, F, D, L, B as laid out in facelet_cube
+    return [
+        ((col - 1) * 2, 3, (row - 1) * 2),
+        (3, (1 - row) * 2, (1 - col) * 2),
+        ((col - 1) * 2, (1 - row) * 2, 3),
+        ((col - 1) * 2, -3, (1 - row) * 2),
+        (-3, (1 - row) * 2, (col - 1) * 2),
+        ((1 - col) * 2, (1 - row) * 2, -3),
+    ][face]
+
+POSITIONS = [facelet_position(facelet) for facelet in range(54)]
+FACELET_AT = {position: facelet for facelet, position in enumerate(POSITIONS)}
+
+def symmetry_tables():
+    """ Returns the facelet permutation of each of the 48 symmetries of
+        the cube, 24 rotations and their mirror images, the identity
+        first. """
+    tables = []
+    for x, y, z in permutations(range(3)):
+        for sx, sy, sz in product((1, -1), repeat=3):
+            tables.append(bytes([FACELET_AT[sx * position[x], sy * position[y], sz * position[z]] for position in POSITIONS]))
+    return tables
+
+SYMMETRY_TABLES = symmetry_tables()
+# conjugating a state takes a translate of its values and a gather by
+# the inverse permutation
+SYMMETRY_TRANSLATIONS = [table + bytes(256 - 54) for table in SYMMETRY_TABLES]
+SYMMETRY_INVERSES = []
+for table in SYMMETRY_TABLES:
+    inverse = bytearray(54)
+    for facelet, image in enumerate(table):
+        inverse[image] = facelet
+    SYMMETRY_INVERSES.append(itemgetter(*inverse))
+
+def conjugate(state, symmetry):
+    """ Returns the state seen through a symmetry: the facelet at position
+        i coming from j becomes the facelet at s(i) coming from s(j). """
+    return bytes(SYMMETRY_INVERSES[symmetry](state.translate(SYMMETRY_TRANSLATIONS[symmetry])))
+
+def pair_orbits():
+    """ Numbers the pairs (position, facelet there) up to a symmetry, the
+        sorted numbers of a state are the same for all of its conjugates.
+        There are fewer than 256 of them. """
+    numbers = bytearray(54 * 54)
+    orbits = {}
+    for facelet in range(54):
+        for source in range(54):
+            orbit = min(table[facelet] * 54 + table[source] for table in SYMMETRY_TABLES)
+            numbers[facelet * 54 + source] = orbits.setdefault(orbit, len(orbits))
+    return bytes(numbers)
+
+# built on first use, loading the plugin doesn't need it
+PAIR_ORBITS = None
+ROWS = range(0, 54 * 54, 54)
+
+def fingerprint(state):
+    """ A cheap hash key of a state's class, only conjugates are sure to
+        share it. """
+    global PAIR_ORBITS
+    if PAIR_ORBITS is None:
+        PAIR_ORBITS = pair_orbits()
+    orbits = PAIR_ORBITS
+    return bytes(sorted([orbits[row + source] for row, source in zip(ROWS, state)]))
+
+@lru_cache(maxsize=4096)
+def canonical_state(state):
+    """ Returns the smallest of the 48 conjugates of a FaceletCube state,
+        equal for states that only differ by a symmetry. """
+    return min(conjugate(state, symmetry) for symmetry in range(48))
+
+class SymmetryClasses:
+    """ States seen so far, grouped by fingerprint. Canonical states are
+        only computed when fingerprints collide. """
+
+    def __init__(self):
+        self.buckets = {}
+
+    def add(self, state, item):
+        """ Returns the item added first with the same state up to a
+            symmetry, item itself when there was none. """
+        bucket = self.buckets.setdefault(fingerprint(state), [])
+        for other, value in bucket:
+            if other == state:
+                return value
+        for other, value in bucket:
+            if canonical_state(other) == canonical_state(state):
+                return value
+        bucket.append((state, item))
+        return item